@@ -0,0 +1,87 @@
+import asyncio
+import main as imageRecognize
+import protocol
+from detections import Detections
+from metrics import MetricsServer
+from server import create_scheduler
+
+
+class AsyncServerSocket:
+    startClass = imageRecognize.Start(imageRecognize.DetectionCache())
+    PORT: int = 9091
+    MAX_BATCH_SIZE: int = 8
+    MAX_WAIT_MS: float = 10
+    INFERENCE_WORKERS: int = 1
+    PROCESS_WORKERS: int = 0
+    MAX_PIPELINE: int = 32
+    METRICS_PORT: int = 9101
+    PROFILE_SAMPLE_RATE: float = 0.0
+
+    def __init__(self) -> None:
+        print("INIT ASYNC SERVER")
+        self.scheduler = create_scheduler(self)
+        if self.METRICS_PORT:
+            MetricsServer(self.METRICS_PORT).start()
+
+    async def client_handler(self, reader, writer):
+        write_lock = asyncio.Lock()
+        pipeline = asyncio.Semaphore(self.MAX_PIPELINE)
+        tasks = set()
+        try:
+            while True:
+                try:
+                    payload = await protocol.read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                await pipeline.acquire()
+                task = asyncio.ensure_future(self.request_handler(payload, writer, write_lock))
+                task.add_done_callback(lambda done: pipeline.release())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ValueError, ConnectionError) as Err:
+            print(Err)
+        finally:
+            writer.close()
+
+    async def request_handler(self, payload, writer, write_lock):
+        request_id, header = None, {}
+        try:
+            header, image = protocol.decode_request(payload)
+            request_id = header.get('id')
+            if not image and not header.get('path'):
+                raise ValueError("request has neither image bytes nor a path")
+            future = self.scheduler.submit(int(header.get('create_model', 0)), image or header['path'],
+                                           float(header.get('threshold', 1.0)),
+                                           header.get('detection_class', 'all'), bool(header.get('render', False)),
+                                           header.get('net_size'))
+            result = await asyncio.wrap_future(future)
+        except (ValueError, KeyError, TypeError) as Err:
+            print(Err)
+            result = {'status': "400", 'detections': Detections()}
+        except Exception as Err:
+            print(request_id, Err)
+            result = {'status': "500", 'detections': Detections()}
+        response, body = dict(result, id=request_id), ()
+        if header.get('format') == 'binary':
+            body = response.pop('detections').to_buffers()
+        else:
+            response['detections'] = self.startClass.format_detections(response['detections'])
+        async with write_lock:
+            writer.writelines(protocol.encode_response(response, body))
+            await writer.drain()
+            if request_id is None:
+                # without an id the client cannot match this answer, so the stream is no longer usable
+                writer.close()
+
+    async def start_listen(self):
+        server = await asyncio.start_server(self.client_handler, '', self.PORT)
+        print("ASYNC SERVER IS START")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    serv = AsyncServerSocket()
+    asyncio.run(serv.start_listen())
@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+import numpy as np
+import main as imageRecognize
+
+STAGES = ['load_image_pixels', 'predict', 'decode_netout_arrays', 'correct_yolo_coords', 'nms_arrays',
+          'select_detections', 'draw_detections']
+
+
+def summarize(samples, elapsed=None):
+    samples = np.asarray(samples, dtype='float64') * 1000.
+    if len(samples) == 0:
+        return {'count': 0}
+    elapsed = elapsed if elapsed is not None else samples.sum() / 1000.
+    return {'count': int(len(samples)),
+            'mean_ms': float(samples.mean()),
+            'p50_ms': float(np.percentile(samples, 50)),
+            'p95_ms': float(np.percentile(samples, 95)),
+            'p99_ms': float(np.percentile(samples, 99)),
+            'throughput': float(len(samples) / elapsed) if elapsed > 0 else 0.0}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+def synthetic_netouts(objects: int, shape=(416, 416), seed: int = 0):
+    rng = np.random.default_rng(seed)
+    startClass = imageRecognize.Start()
+    vehicles = [startClass.LABELS.index(label) for label in ('car', 'bus', 'truck', 'motorbike')]
+    netouts = []
+    for stride in (32, 16, 8):
+        grid_h, grid_w = shape[1] // stride, shape[0] // stride
+        netout = rng.normal(-6, 1, (grid_h, grid_w, 3, 85)).astype('float32')
+        netout[..., 2:4] = rng.normal(0, 0.5, netout[..., 2:4].shape)
+        # a crowd of confident vehicles, each detected by a few neighbouring cells to give NMS work
+        for k in range(objects // 3):
+            row, col, b = rng.integers(0, grid_h), rng.integers(0, grid_w), rng.integers(0, 3)
+            for d_row, d_col in ((0, 0), (0, 1), (1, 0)):
+                cell = netout[min(row + d_row, grid_h - 1), min(col + d_col, grid_w - 1), b]
+                cell[4] = rng.uniform(2, 6)
+                cell[5 + vehicles[rng.integers(0, len(vehicles))]] = rng.uniform(2, 6)
+        netouts.append(netout.reshape(grid_h, grid_w, 255))
+    return netouts
+
+
+def time_postprocess(timings, netouts, image_w, image_h, shape, threshold, image=None, output_dir=None):
+    startClass = imageRecognize.Start()
+    dt = imageRecognize.DetectObject()
+    class_ids = startClass.class_ids('all')
+    start = time.perf_counter()
+    decoded = [dt.decode_netout_arrays(netouts[i], startClass.ANCHORS[i], startClass.OBJ_THRESH, shape[1], shape[0],
+                                       class_ids) for i in range(len(netouts))]
+    coords, objectness, classes = [np.concatenate([part[k] for part in decoded]) for k in range(3)]
+    timings['decode_netout_arrays'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    coords = dt.correct_yolo_coords(coords, image_h, image_w, shape[1], shape[0])
+    timings['correct_yolo_coords'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    dt.nms_arrays(coords, classes, startClass.NMS_THRESH)
+    timings['nms_arrays'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    detections = dt.select_detections(coords, objectness, classes, threshold, class_ids)
+    timings['select_detections'].append(time.perf_counter() - start)
+
+    if image is not None:
+        start = time.perf_counter()
+        dt.draw_detections(os.path.join(output_dir, 'bench'), detections, startClass.LABELS, (400, 400), image)
+        timings['draw_detections'].append(time.perf_counter() - start)
+    return len(coords), len(detections)
+
+
+def bench_corpus(image_paths, repeat: int, shape, threshold: float, use_model: bool, draw: bool):
+    timings = {stage: [] for stage in STAGES}
+    li = imageRecognize.LoadImage()
+    predict = imageRecognize.ModelRegistry().get_predictor(shape) if use_model else None
+    with tempfile.TemporaryDirectory() as output_dir:
+        for r in range(repeat):
+            for image_path in image_paths:
+                start = time.perf_counter()
+                pixels, image_w, image_h = li.load_image_pixels(image_path, shape)
+                timings['load_image_pixels'].append(time.perf_counter() - start)
+                if predict is None:
+                    continue
+                start = time.perf_counter()
+                netouts = [yolo.numpy()[0] for yolo in predict(pixels)]
+                timings['predict'].append(time.perf_counter() - start)
+                image = li.decode_image(image_path)[0] if draw else None
+                time_postprocess(timings, netouts, image_w, image_h, shape, threshold, image, output_dir)
+    return {stage: summarize(samples) for stage, samples in timings.items() if samples}
+
+
+def bench_synthetic(objects: int, scenes: int, shape, threshold: float):
+    timings = {stage: [] for stage in STAGES}
+    candidates, detections = [], []
+    for seed in range(scenes):
+        netouts = synthetic_netouts(objects, shape, seed)
+        found = time_postprocess(timings, netouts, 1920, 1080, shape, threshold)
+        candidates.append(found[0])
+        detections.append(found[1])
+    result = {stage: summarize(samples) for stage, samples in timings.items() if samples}
+    result['candidates_per_scene'] = float(np.mean(candidates))
+    result['detections_per_scene'] = float(np.mean(detections))
+    return result
+
+
+def bench_server(host: str, port: int, image_paths, clients: int, requests: int, threshold: float):
+    latencies, errors = [], []
+
+    def client(index):
+        sock = socket.socket()
+        sock.connect((host, port))
+        try:
+            for r in range(requests):
+                image_path = image_paths[(index + r) % len(image_paths)]
+                message = "0$$" + image_path + "$$" + str(threshold) + "$$all"
+                start = time.perf_counter()
+                sock.send(message.encode(encoding='utf-16'))
+                status = sock.recv(1024).decode(encoding='utf-8')
+                latencies.append(time.perf_counter() - start)
+                if status != "200":
+                    errors.append(status)
+        finally:
+            sock.close()
+
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    result = summarize(latencies, time.perf_counter() - start)
+    result['clients'] = clients
+    result['errors'] = len(errors)
+    return result
+
+
+def compare(results, baseline, tolerance: float):
+    regressions = []
+    for section, stages in baseline.items():
+        if not isinstance(stages, dict) or section not in results:
+            continue
+        for stage, stats in stages.items():
+            current = results[section].get(stage)
+            if not isinstance(stats, dict) or not isinstance(current, dict) or 'p50_ms' not in stats:
+                continue
+            ratio = current['p50_ms'] / stats['p50_ms'] if stats['p50_ms'] > 0 else 1.0
+            line = "%s.%s p50 %.3fms -> %.3fms (x%.2f)" % (section, stage, stats['p50_ms'], current['p50_ms'], ratio)
+            print(("REGRESSION " if ratio > tolerance else "") + line)
+            if ratio > tolerance:
+                regressions.append(section + '.' + stage)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the detection pipeline")
+    parser.add_argument('--images', default='images')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--net_size', type=int, default=416)
+    parser.add_argument('--threshold', type=float, default=0.6)
+    parser.add_argument('--no_model', action='store_true', help="skip stages that need model.h5")
+    parser.add_argument('--no_draw', action='store_true')
+    parser.add_argument('--objects', type=int, default=150, help="objects per synthetic crowded scene")
+    parser.add_argument('--scenes', type=int, default=20)
+    parser.add_argument('--server', default=None, help="host:port of a running server.py to load-test")
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=10, help="requests per client")
+    parser.add_argument('--output', default=None, help="write results as JSON to this file")
+    parser.add_argument('--baseline', default=None, help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.10, help="allowed p50 slowdown against the baseline")
+    args = parser.parse_args()
+
+    shape = imageRecognize.Start().net_shape(args.net_size)
+    image_paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                         if name.lower().endswith(imageRecognize.LoadImage.IMAGE_EXTENSIONS))
+    results = {'config': vars(args),
+               'corpus': bench_corpus(image_paths, args.repeat, shape, args.threshold, not args.no_model,
+                                      not args.no_draw),
+               'synthetic': bench_synthetic(args.objects, args.scenes, shape, args.threshold)}
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        results['server'] = {'end_to_end': bench_server(host, int(port), [os.path.abspath(path) for path in image_paths],
+                                                        args.clients, args.requests, args.threshold)}
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            sys.exit(1)
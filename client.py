@@ -1,4 +1,8 @@
+import asyncio
+import itertools
 import socket
+import protocol
+from detections import Detections
 
 
 class TestSocket:
@@ -15,6 +19,66 @@ class TestSocket:
         print(data.decode())
 
 
+class AsyncClient:
+
+    def __init__(self, host: str = 'localhost', port: int = 9091) -> None:
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._receiver = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        if self._receiver is not None:
+            self._receiver.cancel()
+
+    async def detect(self, path: str = None, image: bytes = b'', threshold: float = 1.0,
+                     detection_class: str = 'all', render: bool = False, net_size: int = None,
+                     binary: bool = False) -> dict:
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        header = {'id': request_id, 'path': path, 'threshold': threshold, 'detection_class': detection_class,
+                  'render': render, 'net_size': net_size, 'format': 'binary' if binary else 'json'}
+        self.writer.write(protocol.encode_request(header, image))
+        await self.writer.drain()
+        return await future
+
+    async def _receive(self):
+        try:
+            while True:
+                response, body = protocol.decode_response(await protocol.read_frame(self.reader))
+                if response.get('id') is None:
+                    raise ConnectionError("server rejected a request it could not read")
+                if body:
+                    response['detections'] = Detections.from_bytes(body)
+                future = self._pending.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError) as Err:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("connection closed"))
+            self._pending.clear()
+
+
+async def test_async(paths):
+    client = AsyncClient()
+    await client.connect()
+    results = await asyncio.gather(*[client.detect(path) for path in paths])
+    await client.close()
+    for result in results:
+        print(result)
+
+
 if __name__ == "__main__":
     client = TestSocket()
-    client.test_msg()
\ No newline at end of file
+    client.test_msg()
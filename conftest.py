@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+
+class Output:
+
+    def __init__(self, array) -> None:
+        self.array = array
+
+    def numpy(self):
+        return self.array
+
+
+class FakeModel:
+    STRIDES = (32, 16, 8)
+
+    def __init__(self) -> None:
+        self.objects = []
+        self.calls = []
+        self.error = None
+
+    def add(self, row: int, col: int, label: int, head: int = 0):
+        # one confident object in the same cell of every image in the batch
+        self.objects.append((head, row, col, label))
+
+    def predictor(self, shape):
+        def predict(pixels):
+            self.calls.append((tuple(shape), pixels))
+            if self.error is not None:
+                raise self.error
+            outputs = [np.full((len(pixels), shape[1] // stride, shape[0] // stride, 255), -10, dtype='float32')
+                       for stride in self.STRIDES]
+            for head, row, col, label in self.objects:
+                outputs[head][:, row, col, :4] = 0
+                outputs[head][:, row, col, 4] = 5
+                outputs[head][:, row, col, 5 + label] = 5
+            return [Output(output) for output in outputs]
+        return predict
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    import main as imageRecognize
+    model = FakeModel()
+    monkeypatch.setattr(imageRecognize.ModelRegistry, 'get_predictor',
+                        lambda self, shape, model_path=None: model.predictor(shape))
+    monkeypatch.setattr(imageRecognize.ModelRegistry, 'version', lambda self, model_path=None: 'test')
+    return model
@@ -0,0 +1,45 @@
+import struct
+import numpy as np
+
+
+class Detections:
+    HEADER = struct.Struct('<4sI')
+    MAGIC: bytes = b'DET1'
+
+    def __init__(self, coords=None, objectness=None, label=None, score=None) -> None:
+        self.coords = np.asarray(coords if coords is not None else (), dtype='float32').reshape(-1, 4)
+        count = len(self.coords)
+        self.objectness = np.asarray(objectness if objectness is not None else np.zeros(count),
+                                     dtype='float32').reshape(-1)
+        self.label = np.asarray(label if label is not None else np.zeros(count), dtype='int32').reshape(-1)
+        self.score = np.asarray(score if score is not None else np.zeros(count), dtype='float32').reshape(-1)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def to_json(self, names):
+        return [{'label': names[label], 'score': float(score) * 100,
+                 'box': [int(xmin), int(ymin), int(xmax), int(ymax)]}
+                for (xmin, ymin, xmax, ymax), label, score in zip(self.coords.tolist(), self.label.tolist(),
+                                                                   self.score.tolist())]
+
+    def to_buffers(self):
+        # the column buffers are handed out as-is, nothing is copied
+        return [self.HEADER.pack(self.MAGIC, len(self))] + \
+            [memoryview(np.ascontiguousarray(column).reshape(-1).view('uint8'))
+             for column in (self.coords, self.objectness, self.label, self.score)]
+
+    def to_bytes(self) -> bytes:
+        return b''.join(self.to_buffers())
+
+    @staticmethod
+    def from_bytes(data):
+        magic, count = Detections.HEADER.unpack_from(data)
+        if magic != Detections.MAGIC:
+            raise ValueError("not a detections payload")
+        offset = Detections.HEADER.size
+        columns = []
+        for dtype, width in (('float32', 4), ('float32', 1), ('int32', 1), ('float32', 1)):
+            columns.append(np.frombuffer(data, dtype=dtype, count=count * width, offset=offset))
+            offset += count * width * 4
+        return Detections(*columns)
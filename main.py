@@ -1,16 +1,21 @@
 import argparse
+import hashlib
+import io
+import json
+import os
 import numpy as np
 import struct
+import time
+from collections import OrderedDict
+from threading import Lock, local
 
-from matplotlib.patches import Rectangle
-from numpy import expand_dims
+import tensorflow as tf
 from keras.layers import Input, Conv2D, BatchNormalization, LeakyReLU, ZeroPadding2D, UpSampling2D
 from keras.models import load_model, Model
 from keras.layers.merge import add, concatenate
-from keras.preprocessing.image import load_img
-from keras.preprocessing.image import img_to_array
-import matplotlib.pyplot as plt
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
+from detections import Detections
+from metrics import METRICS, Trace
 
 
 class WeightReader:
@@ -24,49 +29,122 @@ class WeightReader:
             else:
                 w_f.read(4)
             transpose = (major > 1000) or (minor > 1000)
-            binary = w_f.read()
+            header_size = w_f.tell()
         self.offset = 0
-        self.all_weights = np.frombuffer(binary, dtype='float32')
+        self.all_weights = np.memmap(weight_file, dtype='float32', mode='r', offset=header_size)
 
     def read_bytes(self, size):
         self.offset = self.offset + size
         return self.all_weights[self.offset - size:self.offset]
 
-    def load_weights(self, model):
+    def layer_weights(self, model):
+        if len(self.all_weights) - self.offset != model.count_params():
+            raise ValueError("weights file holds " + str(len(self.all_weights) - self.offset) +
+                             " parameters, model expects " + str(model.count_params()))
+        layers = {layer.name: layer for layer in model.layers}
         for i in range(106):
-            try:
-                conv_layer = model.get_layer('conv_' + str(i))
-                print("loading weights of convolution #" + str(i))
-                if i not in [81, 93, 105]:
-                    norm_layer = model.get_layer('bnorm_' + str(i))
-                    size = np.prod(norm_layer.get_weights()[0].shape)
-                    beta = self.read_bytes(size)  # bias
-                    gamma = self.read_bytes(size)  # scale
-                    mean = self.read_bytes(size)  # mean
-                    var = self.read_bytes(size)  # variance
-                    weights = norm_layer.set_weights([gamma, beta, mean, var])
-                if len(conv_layer.get_weights()) > 1:
-                    bias = self.read_bytes(np.prod(conv_layer.get_weights()[1].shape))
-                    kernel = self.read_bytes(np.prod(conv_layer.get_weights()[0].shape))
-                    kernel = kernel.reshape(list(reversed(conv_layer.get_weights()[0].shape)))
-                    kernel = kernel.transpose([2, 3, 1, 0])
-                    conv_layer.set_weights([kernel, bias])
-                else:
-                    kernel = self.read_bytes(np.prod(conv_layer.get_weights()[0].shape))
-                    kernel = kernel.reshape(list(reversed(conv_layer.get_weights()[0].shape)))
-                    kernel = kernel.transpose([2, 3, 1, 0])
-                    conv_layer.set_weights([kernel])
-            except ValueError:
-                print("no convolution #" + str(i))
+            conv_layer = layers.get('conv_' + str(i))
+            if conv_layer is None:
+                continue
+            if i not in [81, 93, 105]:
+                norm_layer = layers['bnorm_' + str(i)]
+                size = np.prod(norm_layer.weights[0].shape)
+                beta = self.read_bytes(size)  # bias
+                gamma = self.read_bytes(size)  # scale
+                mean = self.read_bytes(size)  # mean
+                var = self.read_bytes(size)  # variance
+                yield norm_layer, [gamma, beta, mean, var]
+            kernel_shape = tuple(conv_layer.weights[0].shape)
+            if len(conv_layer.weights) > 1:
+                bias = self.read_bytes(np.prod(conv_layer.weights[1].shape))
+                kernel = self.read_bytes(np.prod(kernel_shape))
+                kernel = kernel.reshape(list(reversed(kernel_shape)))
+                yield conv_layer, [kernel.transpose([2, 3, 1, 0]), bias]
+            else:
+                kernel = self.read_bytes(np.prod(kernel_shape))
+                kernel = kernel.reshape(list(reversed(kernel_shape)))
+                yield conv_layer, [kernel.transpose([2, 3, 1, 0])]
+
+    def load_weights(self, model):
+        count = 0
+        for layer, weights in self.layer_weights(model):
+            layer.set_weights(weights)
+            count += 1
+        print("loaded weights of " + str(count) + " layers")
 
     def reset(self):
         self.offset = 0
 
 
+class WeightCache:
+    MAGIC: bytes = b'YOLOWC01'
+    HEADER = struct.Struct('<8sQQ')
+    ALIGN: int = 64
+
+    # layout: [magic][parameter count][index length][json index][padding][float32 data, keras layout]
+    def save(self, model, cache_path: str = 'model.wcache', layer_weights=None):
+        if layer_weights is None:
+            layer_weights = ((layer, layer.get_weights()) for layer in model.layers if layer.weights)
+        index, arrays, offset = {}, [], 0
+        for layer, weights in layer_weights:
+            index[layer.name] = []
+            for weight in weights:
+                index[layer.name].append([offset, list(weight.shape)])
+                arrays.append(weight)
+                offset += int(np.prod(weight.shape))
+        if offset != model.count_params():
+            raise ValueError("cache holds " + str(offset) + " parameters, model expects " + str(model.count_params()))
+        index = json.dumps(index).encode('utf-8')
+        header_size = self.HEADER.size + len(index)
+        padding = -header_size % self.ALIGN
+        # ModelRegistry picks the cache up on its own, so it must never be seen half written
+        with open(cache_path + '.tmp', 'wb') as c_f:
+            c_f.write(self.HEADER.pack(self.MAGIC, offset, len(index)))
+            c_f.write(index)
+            c_f.write(b'\0' * padding)
+            for weight in arrays:
+                np.ascontiguousarray(weight, dtype='float32').tofile(c_f)
+        os.replace(cache_path + '.tmp', cache_path)
+        print("SAVE WEIGHT CACHE: " + cache_path)
+
+    def convert(self, weights_path: str = 'yolov3.weights', cache_path: str = 'model.wcache'):
+        model = CreateModel(make=False).build_yolov3_model()
+        self.save(model, cache_path, WeightReader(weights_path).layer_weights(model))
+        return model
+
+    def open(self, cache_path: str = 'model.wcache'):
+        with open(cache_path, 'rb') as c_f:
+            magic, count, index_size = self.HEADER.unpack(c_f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError(cache_path + " is not a weight cache")
+            index = json.loads(c_f.read(index_size).decode('utf-8'))
+        data_offset = self.HEADER.size + index_size
+        data_offset += -data_offset % self.ALIGN
+        if os.path.getsize(cache_path) != data_offset + count * 4:
+            raise ValueError(cache_path + " is truncated or corrupt")
+        return np.memmap(cache_path, dtype='float32', mode='r', offset=data_offset, shape=(count,)), index
+
+    def load(self, model, cache_path: str = 'model.wcache'):
+        data, index = self.open(cache_path)
+        if len(data) != model.count_params():
+            raise ValueError("cache holds " + str(len(data)) + " parameters, model expects " +
+                             str(model.count_params()))
+        for name, entries in index.items():
+            layer = model.get_layer(name)
+            weights = [data[offset:offset + int(np.prod(shape))].reshape(shape) for offset, shape in entries]
+            if [list(weight.shape) for weight in layer.weights] != [shape for offset, shape in entries]:
+                raise ValueError("cache layout does not match layer " + name)
+            layer.set_weights(weights)
+        return model
+
+
 class CreateModel:
-    def __init__(self):
-        print("START INIT")
-        self.make_yolov3_model()
+    fold_bn: bool = False
+
+    def __init__(self, make: bool = True):
+        if make:
+            print("START INIT")
+            self.make_yolov3_model()
 
     def _conv_block(self, inp, convs, skip=True):
         x = inp
@@ -82,12 +160,20 @@ class CreateModel:
                        strides=conv['stride'],
                        padding='valid' if conv['stride'] > 1 else 'same',
                        name='conv_' + str(conv['layer_idx']),
-                       use_bias=False if conv['bnorm'] else True)(x)
-            if conv['bnorm']: x = BatchNormalization(epsilon=0.001, name='bnorm_' + str(conv['layer_idx']))(x)
+                       use_bias=False if conv['bnorm'] and not self.fold_bn else True)(x)
+            if conv['bnorm'] and not self.fold_bn:
+                x = BatchNormalization(epsilon=0.001, name='bnorm_' + str(conv['layer_idx']))(x)
             if conv['leaky']: x = LeakyReLU(alpha=0.1, name='leaky_' + str(conv['layer_idx']))(x)
         return add([skip_connection, x]) if skip else x
 
     def make_yolov3_model(self):
+        model = self.build_yolov3_model()
+        print("INIT DONE")
+        print("LOAD WEIGHT START")
+        self.load_weights_and_save(model)
+
+    def build_yolov3_model(self, fold_bn: bool = False):
+        self.fold_bn = fold_bn
         input_image = Input(shape=(None, None, 3))
         # Layer  0 => 4
         x = self._conv_block(input_image,
@@ -191,13 +277,53 @@ class CreateModel:
              'layer_idx': 104},
             {'filter': 255, 'kernel': 1, 'stride': 1, 'bnorm': False, 'leaky': False,
              'layer_idx': 105}], skip=False)
-        model = Model(input_image, [yolo_82, yolo_94, yolo_106])
-        print("INIT DONE")
-        print("LOAD WEIGHT START")
-        self.load_weights_and_save(model)
+        return Model(input_image, [yolo_82, yolo_94, yolo_106])
 
     # define the model
 
+    def fold_batchnorm(self, model):
+        folded = self.build_yolov3_model(fold_bn=True)
+        for layer in folded.layers:
+            if not layer.name.startswith('conv_'):
+                continue
+            weights = model.get_layer(layer.name).get_weights()
+            try:
+                norm_layer = model.get_layer('bnorm_' + layer.name[len('conv_'):])
+            except ValueError:
+                layer.set_weights(weights)
+                continue
+            gamma, beta, mean, var = norm_layer.get_weights()
+            scale = gamma / np.sqrt(var + norm_layer.epsilon)
+            layer.set_weights([weights[0] * scale, beta - mean * scale])
+        return folded
+
+    def check_folded(self, model, folded, image_paths, shape=(416, 416)):
+        li = LoadImage()
+        max_diff = 0.0
+        for image_path in image_paths:
+            image, image_w, image_h = li.load_image_pixels(image_path, shape)
+            for expected, actual in zip(model.predict(image), folded.predict(image)):
+                max_diff = max(max_diff, float(np.abs(expected - actual).max()))
+        return max_diff
+
+    def export_folded(self, model_path: str = 'model.h5', folded_path: str = 'model_folded.h5',
+                      check_images='images', tolerance: float = 1e-3):
+        model = load_model(model_path)
+        folded = self.fold_batchnorm(model)
+        if isinstance(check_images, str):
+            check_images = [os.path.join(check_images, name) for name in sorted(os.listdir(check_images))
+                            if name.lower().endswith(LoadImage.IMAGE_EXTENSIONS)]
+            if not check_images:
+                raise ValueError("no images to check the folded model against")
+        if check_images is not None:
+            max_diff = self.check_folded(model, folded, check_images)
+            print("FOLDED MODEL MAX DIFF: %.6f" % max_diff)
+            if max_diff > tolerance:
+                raise ValueError("folded model differs from " + model_path + " by " + str(max_diff))
+        folded.save(folded_path)
+        print("SAVE FOLDED MODEL: " + folded_path)
+        return folded
+
     def load_weights_and_save(self, model):
         weight_reader = WeightReader('yolov3.weights')
         weight_reader.load_weights(model)
@@ -205,6 +331,7 @@ class CreateModel:
         model_json = model.to_json()
         with open('model.json', "w") as json_file:
             json_file.write(model_json)
+        WeightCache().save(model, 'model.wcache')
         print("LOAD WEIGHT END.")
         print("SAVE MODEL: OK.")
 
@@ -263,171 +390,700 @@ class DetectObject:
         union = w1 * h1 + w2 * h2 - intersect
         return float(intersect) / union
 
-    def do_nms(self, boxes, nms_thresh):
-        if len(boxes) > 0:
-            nb_class = len(boxes[0].classes)
-        else:
-            return
+    def _iou_matrix(self, coords_a, coords_b):
+        intersect_w = np.minimum(coords_a[:, np.newaxis, 2], coords_b[np.newaxis, :, 2]) - \
+            np.maximum(coords_a[:, np.newaxis, 0], coords_b[np.newaxis, :, 0])
+        intersect_h = np.minimum(coords_a[:, np.newaxis, 3], coords_b[np.newaxis, :, 3]) - \
+            np.maximum(coords_a[:, np.newaxis, 1], coords_b[np.newaxis, :, 1])
+        intersect = np.clip(intersect_w, 0, None) * np.clip(intersect_h, 0, None)
+        area_a = (coords_a[:, 2] - coords_a[:, 0]) * (coords_a[:, 3] - coords_a[:, 1])
+        area_b = (coords_b[:, 2] - coords_b[:, 0]) * (coords_b[:, 3] - coords_b[:, 1])
+        union = area_a[:, np.newaxis] + area_b[np.newaxis, :] - intersect
+        return np.divide(intersect, union, out=np.zeros_like(intersect), where=union > 0)
 
-        for c in range(nb_class):
-            sorted_indices = np.argsort([-box.classes[c] for box in boxes])
-            for i in range(len(sorted_indices)):
-                index_i = sorted_indices[i]
-                if boxes[index_i].classes[c] == 0: continue
-                for j in range(i + 1, len(sorted_indices)):
-                    index_j = sorted_indices[j]
+    def _nms_keep(self, coords, scores, nms_thresh):
+        order = np.argsort(-scores, kind='stable')
+        iou = self._iou_matrix(coords[order], coords[order])
+        keep = np.ones(len(order), dtype=bool)
+        for i in range(len(order)):
+            if keep[i]:
+                keep[i + 1:] &= iou[i, i + 1:] < nms_thresh
+        return order[keep]
 
-                    if self.bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
-                        boxes[index_j].classes[c] = 0
+    def nms_arrays(self, coords, classes, nms_thresh, batched: bool = False):
+        box_index, class_index = np.nonzero(classes)
+        if len(box_index) == 0:
+            return classes
+        coords = np.asarray(coords, dtype='float64')
+        suppressed = np.ones(len(box_index), dtype=bool)
+        if batched:
+            # shift every class into its own coordinate range so one pass never mixes classes
+            span = coords.max() - coords.min() + 1
+            shifted = coords[box_index] + (class_index * span)[:, np.newaxis]
+            suppressed[self._nms_keep(shifted, classes[box_index, class_index], nms_thresh)] = False
+        else:
+            for c in np.unique(class_index):
+                members = np.flatnonzero(class_index == c)
+                keep = self._nms_keep(coords[box_index[members]], classes[box_index[members], c], nms_thresh)
+                suppressed[members[keep]] = False
+        classes[box_index[suppressed], class_index[suppressed]] = 0
+        return classes
 
-    def decode_netout(self, netout, anchors, obj_thresh, net_h, net_w):
+    def do_nms(self, boxes, nms_thresh, batched: bool = False):
+        if len(boxes) == 0:
+            return
+        coords = np.array([[box.xmin, box.ymin, box.xmax, box.ymax] for box in boxes], dtype='float64')
+        classes = self.nms_arrays(coords, np.array([box.classes for box in boxes]), nms_thresh, batched)
+        for box, scores in zip(boxes, classes):
+            box.classes = scores
+
+    def decode_netout_arrays(self, netout, anchors, obj_thresh, net_h, net_w, class_ids=None):
         grid_h, grid_w = netout.shape[:2]
         nb_box = 3
-        netout = netout.reshape((grid_h, grid_w, nb_box, -1))
-        nb_class = netout.shape[-1] - 5
-
-        boxes = []
-
-        netout[..., :2] = self._sigmoid(netout[..., :2])
-        netout[..., 4:] = self._sigmoid(netout[..., 4:])
-        netout[..., 5:] = netout[..., 4][..., np.newaxis] * netout[..., 5:]
-        netout[..., 5:] *= netout[..., 5:] > obj_thresh
-
-        for i in range(grid_h * grid_w):
-            row = i / grid_w
-            col = i % grid_w
-
-            for b in range(nb_box):
-                objectness = netout[int(row)][int(col)][b][4]
-                if (objectness.all() <= obj_thresh): continue
-                x, y, w, h = netout[int(row)][int(col)][b][:4]
-                x = (col + x) / grid_w
-                y = (row + y) / grid_h
-                w = anchors[2 * b + 0] * np.exp(w) / net_w
-                h = anchors[2 * b + 1] * np.exp(h) / net_h
-                classes = netout[int(row)][col][b][5:]
-                box = BoundBox(x - w / 2, y - h / 2, x + w / 2, y + h / 2, objectness, classes)
-                boxes.append(box)
-
-        return boxes
-
-    def correct_yolo_boxes(self, boxes, image_h, image_w, net_h, net_w):
-        if (float(net_w) / image_w) > (float(net_h) / image_h):
-            new_w = net_w
-            new_h = (image_h * net_w) / image_w
-        else:
-            new_h = net_w
-            new_w = (image_w * net_h) / image_h
-
-        for i in range(len(boxes)):
-            x_offset, x_scale = (net_w - new_w) / 2. / net_w, float(new_w) / net_w
-            y_offset, y_scale = (net_h - new_h) / 2. / net_h, float(new_h) / net_h
-
-            boxes[i].xmin = int((boxes[i].xmin - x_offset) / x_scale * image_w)
-            boxes[i].xmax = int((boxes[i].xmax - x_offset) / x_scale * image_w)
-            boxes[i].ymin = int((boxes[i].ymin - y_offset) / y_scale * image_h)
-            boxes[i].ymax = int((boxes[i].ymax - y_offset) / y_scale * image_h)
-
-    def draw_boxes(self, filename, v_boxes, v_labels, v_scores, detection: str = 'all', dpi: (int, int) = (300, 300)):
-        data = plt.imread(filename)
-        plt.imshow(data)
-        ax = plt.gca()
-        for i in range(len(v_boxes)):
-            box = v_boxes[i]
-            y1, x1, y2, x2 = box.ymin, box.xmin, box.ymax, box.xmax
-            width, height = x2 - x1, y2 - y1
-            if detection == 'all':
-                if v_labels[i] == 'bus' \
-                        or v_labels[i] == 'car' \
-                        or v_labels[i] == 'truck' \
-                        or v_labels[i] == 'motorbike':
-                    rect = Rectangle((x1, y1), width, height, fill=False, color='red')
-                    ax.add_patch(rect)
-                    label = "%s (%.3f)" % (v_labels[i], v_scores[i])
-                    plt.text(x1, y1, label, color='red')
-            else:
-                if detection == v_labels[i]:
-                    rect = Rectangle((x1, y1), width, height, fill=False, color='red')
-                    ax.add_patch(rect)
-                    label = "%s (%.3f)" % (v_labels[i], v_scores[i])
-                    plt.text(x1, y1, label, color='red')
-
-        plt.xticks([])
-        plt.yticks([])
-        plt.autoscale()
-        plt.axis('off')
-        print(filename + ".result.png")
-        plt.savefig(filename + ".result.png", bbox_inches='tight', pad_inches=0, format="png", dpi=dpi[0])
+        netout = netout.reshape((grid_h * grid_w * nb_box, -1))
+
+        objectness = self._sigmoid(netout[:, 4])
+        index = np.flatnonzero(objectness > obj_thresh)
+        netout = netout[index]
+        objectness = objectness[index]
+
+        cell, b = np.divmod(index, nb_box)
+        row = (cell // grid_w).astype('float32')
+        col = (cell % grid_w).astype('float32')
+        anchors = np.asarray(anchors, dtype='float32').reshape((nb_box, 2))
+
+        xy = self._sigmoid(netout[:, :2])
+        x = (col + xy[:, 0]) / grid_w
+        y = (row + xy[:, 1]) / grid_h
+        w = anchors[b, 0] * np.exp(netout[:, 2]) / net_w
+        h = anchors[b, 1] * np.exp(netout[:, 3]) / net_h
+        coords = np.stack([x - w / 2, y - h / 2, x + w / 2, y + h / 2], axis=1)
+
+        if class_ids is None:
+            classes = objectness[:, np.newaxis] * self._sigmoid(netout[:, 5:])
+            classes *= classes > obj_thresh
+            return coords, objectness, classes
+        # only the requested class columns are activated; candidates without one of them go no further
+        classes = objectness[:, np.newaxis] * self._sigmoid(netout[:, 5 + np.asarray(class_ids, dtype=int)])
+        classes *= classes > obj_thresh
+        keep = classes.any(axis=1)
+        return coords[keep], objectness[keep], classes[keep]
+
+    def correct_yolo_coords(self, coords, image_h, image_w, net_h, net_w):
+        # undo the letterbox applied by LoadImage: the image was scaled to fit and centred on the grid
+        scale = min(float(net_w) / image_w, float(net_h) / image_h)
+        new_w, new_h = image_w * scale, image_h * scale
+        offset = np.array([(net_w - new_w) / 2. / net_w, (net_h - new_h) / 2. / net_h] * 2)
+        size = np.array([float(new_w) / net_w / image_w, float(new_h) / net_h / image_h] * 2)
+        return np.trunc((np.asarray(coords, dtype='float64') - offset) / size)
+
+    def draw_detections(self, filename, detections: Detections, labels, dpi: (int, int) = (300, 300), image=None,
+                        fmt: str = 'png', quality: int = 95):
+        rows = [(coords, labels[label], score * 100) for coords, label, score in
+                zip(detections.coords.tolist(), detections.label.tolist(), detections.score.tolist())]
+        if image is None:
+            image = Image.open(filename).convert('RGB')
+        draw = ImageDraw.Draw(image)
+        line_width = max(1, round(max(image.size) / 500))
+        try:
+            font = ImageFont.load_default(max(12, max(image.size) // 60))
+        except TypeError:
+            font = ImageFont.load_default()
+        for (x1, y1, x2, y2), label, score in rows:
+            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+            draw.rectangle([x1, y1, x2, y2], outline='red', width=line_width)
+            label = "%s (%.3f)" % (label, score)
+            text_box = draw.textbbox((0, 0), label, font=font)
+            draw.text((x1, max(0, y1 - text_box[3] - line_width)), label, fill='red', font=font)
+
+        output = filename + ".result." + fmt
+        print(output)
+        image_format = 'JPEG' if fmt.lower() in ('jpg', 'jpeg') else fmt.upper()
+        options = {'dpi': dpi}
+        if image_format in ('JPEG', 'WEBP'):
+            options['quality'] = quality
+        image.save(output, format=image_format, **options)
         return True
 
-    def get_boxes(self, boxes, labels, thresh):
-        v_boxes, v_labels, v_scores = list(), list(), list()
-        for box in boxes:
-            for i in range(len(labels)):
-                if box.classes[i] > thresh:
-                    v_boxes.append(box)
-                    v_labels.append(labels[i])
-                    v_scores.append(box.classes[i] * 100)
-        return v_boxes, v_labels, v_scores
+    def select_detections(self, coords, objectness, classes, thresh, class_ids=None):
+        # every (box, class) pair above the threshold, box by box, without a Python object per candidate
+        box_index, column = np.nonzero(classes > thresh)
+        label = column if class_ids is None else np.asarray(class_ids, dtype=int)[column]
+        return Detections(coords[box_index], objectness[box_index], label, classes[box_index, column])
 
 
 class LoadImage:
+    FILL_VALUE: float = 0.5
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+    MAX_BUFFERS: int = 4
+
+    def __init__(self) -> None:
+        self._buffers = OrderedDict()
+
+    def get_buffer(self, shape, batch_size: int = 1):
+        # one buffer per input shape, grown to the largest batch seen; smaller batches get a view of it
+        key = tuple(shape)
+        buffer = self._buffers.get(key)
+        if buffer is None or len(buffer) < batch_size:
+            buffer = self._buffers[key] = np.empty((batch_size, shape[1], shape[0], 3), dtype='float32')
+        self._buffers.move_to_end(key)
+        while len(self._buffers) > self.MAX_BUFFERS:
+            self._buffers.popitem(last=False)
+        return buffer[:batch_size]
 
-    def load_image_pixels(self, filename, shape):
-        image = load_img(filename)
+    def decode_image(self, source, shape=None):
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
         width, height = image.size
-        image = load_img(filename, target_size=shape)
-        image = img_to_array(image)
-        image = image.astype('float32')
-        image /= 255.0
-        image = expand_dims(image, 0)
-        return image, width, height
+        if shape is not None and image.format == 'JPEG':
+            # let libjpeg downscale while decoding, never below the letterboxed size
+            scale = min(float(shape[0]) / width, float(shape[1]) / height)
+            image.draft('RGB', (max(1, int(width * scale)), max(1, int(height * scale))))
+        return image.convert('RGB'), width, height
+
+    def letterbox(self, image, width, height, shape, out=None):
+        net_w, net_h = shape
+        if out is None:
+            out = np.empty((net_h, net_w, 3), dtype='float32')
+        scale = min(float(net_w) / width, float(net_h) / height)
+        new_w, new_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+        left, top = (net_w - new_w) // 2, (net_h - new_h) // 2
+        resized = np.asarray(image.resize((new_w, new_h), Image.BILINEAR, reducing_gap=3.0))
+        out.fill(self.FILL_VALUE)
+        np.divide(resized, 255.0, out=out[top:top + new_h, left:left + new_w], dtype='float32')
+        return out
+
+    def load_image_pixels(self, filename, shape, out=None):
+        image, width, height = self.decode_image(filename, shape)
+        return self.letterbox(image, width, height, shape, out)[np.newaxis], width, height
+
+    def load_image_array(self, data, shape, out=None):
+        image = Image.fromarray(data)
+        width, height = image.size
+        return self.letterbox(image, width, height, shape, out)[np.newaxis], width, height
+
+
+class ModelRegistry:
+    MODEL_PATH: str = 'model.h5'
+    WARMUP_SHAPE: (int, int) = (416, 416)
+    MAX_PREDICTORS: int = 16
+    _models = {}
+    _metrics = {}
+    _predictors = OrderedDict()
+    _lock = Lock()
+
+    def model_path(self, model_path: str = None):
+        if model_path:
+            return model_path
+        # the memory-mapped weight cache written next to the model loads much faster, unless it is stale
+        cache_path = os.path.splitext(self.MODEL_PATH)[0] + '.wcache'
+        if os.path.exists(cache_path) and (not os.path.exists(self.MODEL_PATH) or
+                                           os.path.getmtime(cache_path) >= os.path.getmtime(self.MODEL_PATH)):
+            return cache_path
+        return self.MODEL_PATH
+
+    def get_model(self, model_path: str = None, warmup: bool = True):
+        model_path = self.model_path(model_path)
+        model = self._models.get(model_path)
+        if model is not None:
+            return model
+        with self._lock:
+            if model_path not in self._models:
+                self._load(model_path, warmup)
+            return self._models[model_path]
+
+    def reload(self, model_path: str = None, warmup: bool = True):
+        model_path = self.model_path(model_path)
+        with self._lock:
+            self._load(model_path, warmup)
+            return self._models[model_path]
+
+    def get_predictor(self, shape, model_path: str = None):
+        model_path = self.model_path(model_path)
+        key = (model_path, tuple(shape))
+        predictor = self._predictors.get(key)
+        if predictor is not None:
+            try:
+                # least recently used goes first, so the shapes in use stay traced
+                self._predictors.move_to_end(key)
+            except KeyError:
+                pass
+            return predictor
+        model = self.get_model(model_path)
+        with self._lock:
+            if key not in self._predictors:
+                while len(self._predictors) >= self.MAX_PREDICTORS:
+                    self._predictors.popitem(last=False)
+                self._predictors[key] = self._trace(model, shape)
+            return self._predictors[key]
+
+    def _trace(self, model, shape):
+        # one traced graph per input resolution, shared by every batch of that size
+        print("COMPILE PREDICTOR %dx%d" % tuple(shape))
+        return tf.function(lambda images: model(images, training=False),
+                           input_signature=[tf.TensorSpec((None, shape[1], shape[0], 3), tf.float32)])
+
+    def metrics(self, model_path: str = None):
+        return dict(self._metrics.get(self.model_path(model_path), {}))
+
+    def version(self, model_path: str = None):
+        return self.metrics(model_path).get('version', '')
+
+    def _load(self, model_path, warmup):
+        print("LOAD MODEL " + model_path)
+        start = time.perf_counter()
+        if model_path.endswith('.wcache'):
+            model = WeightCache().load(CreateModel(make=False).build_yolov3_model(), model_path)
+        else:
+            model = load_model(model_path)
+        load_time = time.perf_counter() - start
+        for key in [key for key in list(self._predictors) if key[0] == model_path]:
+            del self._predictors[key]
+        warmup_time = 0.0
+        if warmup:
+            # trace the predictor requests use, so the first request does not pay for it
+            start = time.perf_counter()
+            predictor = self._trace(model, self.WARMUP_SHAPE)
+            predictor(np.zeros((1, self.WARMUP_SHAPE[1], self.WARMUP_SHAPE[0], 3), dtype='float32'))
+            self._predictors[(model_path, tuple(self.WARMUP_SHAPE))] = predictor
+            warmup_time = time.perf_counter() - start
+        loads = self._metrics.get(model_path, {}).get('loads', 0) + 1
+        self._models[model_path] = model
+        version = os.path.basename(model_path) + '@' + str(int(os.path.getmtime(model_path)))
+        self._metrics[model_path] = {'load_time': load_time, 'warmup_time': warmup_time, 'loads': loads,
+                                     'version': version}
+        print("MODEL READY: load %.3fs, warmup %.3fs" % (load_time, warmup_time))
+
+
+class DetectionCache:
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 512 * 1024 * 1024, cache_dir: str = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'write_errors': 0}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, data: bytes, model_version: str) -> str:
+        return hashlib.sha256(data).hexdigest() + '-' + hashlib.sha1(model_version.encode('utf-8')).hexdigest()[:16]
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                METRICS.inc('yolo_cache_lookups_total', result='hit')
+                return entry
+        entry = self._read(key)
+        with self._lock:
+            if entry is None:
+                self._stats['misses'] += 1
+                METRICS.inc('yolo_cache_lookups_total', result='miss')
+                return None
+            self._stats['disk_hits'] += 1
+            METRICS.inc('yolo_cache_lookups_total', result='disk_hit')
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, netouts, image_w: int, image_h: int):
+        entry = ([np.array(netout) for netout in netouts], image_w, image_h)
+        self._remember(key, entry)
+        if self.cache_dir is not None:
+            self._write(key, entry)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+
+    def _remember(self, key, entry):
+        size = sum(netout.nbytes for netout in entry[0])
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= sum(netout.nbytes for netout in self._entries.pop(key)[0])
+            self._entries[key] = entry
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= sum(netout.nbytes for netout in evicted[0])
+                self._stats['evictions'] += 1
+                METRICS.inc('yolo_cache_evictions_total')
+            METRICS.set('yolo_cache_entries', len(self._entries))
+            METRICS.set('yolo_cache_bytes', self._bytes)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _read(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with np.load(self._path(key)) as data:
+                count = int(data['count'])
+                return [data['netout_' + str(i)] for i in range(count)], int(data['image_w']), int(data['image_h'])
+        except (OSError, ValueError, KeyError) as Err:
+            print(Err)
+            return None
+
+    def _write(self, key, entry):
+        arrays = {'netout_' + str(i): netout for i, netout in enumerate(entry[0])}
+        tmp_path = self._path(key) + '.' + str(os.getpid()) + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                np.savez(cache_file, count=len(entry[0]), image_w=entry[1], image_h=entry[2], **arrays)
+            os.replace(tmp_path, self._path(key))
+        except OSError as Err:
+            # a full or read-only disk only costs the second tier, never the request
+            print(Err)
+            with self._lock:
+                self._stats['write_errors'] += 1
+            METRICS.inc('yolo_cache_write_errors_total')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def read_labels(path, default):
+    try:
+        with open(path) as names_file:
+            labels = [line.strip() for line in names_file if line.strip()]
+    except OSError:
+        return list(default)
+    if len(labels) != len(default):
+        print(path + " lists " + str(len(labels)) + " classes, the model has " + str(len(default)))
+        return list(default)
+    return labels
 
 
 class Start:
+    LABELS = read_labels(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'coco.names'),
+                         ["person", "bicycle", "car", "motorbike", "aeroplane", "bus", "train", "truck",
+                          "boat", "traffic light", "fire hydrant", "stop sign", "parking meter", "bench",
+                          "bird", "cat", "dog", "horse", "sheep", "cow", "elephant", "bear", "zebra", "giraffe",
+                          "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee", "skis", "snowboard",
+                          "sports ball", "kite", "baseball bat", "baseball glove", "skateboard", "surfboard",
+                          "tennis racket", "bottle", "wine glass", "cup", "fork", "knife", "spoon", "bowl", "banana",
+                          "apple", "sandwich", "orange", "broccoli", "carrot", "hot dog", "pizza", "donut", "cake",
+                          "chair", "sofa", "pottedplant", "bed", "diningtable", "toilet", "tvmonitor", "laptop",
+                          "mouse", "remote", "keyboard", "cell phone", "microwave", "oven", "toaster", "sink",
+                          "refrigerator", "book", "clock", "vase", "scissors", "teddy bear", "hair drier",
+                          "toothbrush"])
+    # named class filters; 'all' predates the groups and has always meant the vehicle subset
+    CLASS_GROUPS = {'vehicles': ['bus', 'car', 'truck', 'motorbike'],
+                    'all': ['bus', 'car', 'truck', 'motorbike']}
+    ANCHORS = [[116, 90, 156, 198, 373, 326], [30, 61, 62, 45, 59, 119], [10, 13, 16, 30, 33, 23]]
+    NET_H: int = 416
+    NET_W: int = 416
+    OBJ_THRESH: float = 0.5
+    NMS_THRESH: float = 0.45
+    BATCH_SIZE: int = 8
+    MAX_NET_SIZE: int = 1024
+    RENDER_FORMAT: str = 'png'
+    RENDER_QUALITY: int = 95
+    TILE_SIZE: int = 416
+    TILE_OVERLAP: int = 64
+    TILE_REDUCE: int = 4
+    TILE_MIN_STD: float = 3.0
+    TILE_MIN_MOTION: float = 2.0
+    TILE_MAX_REUSE: int = 30
+
+    def __init__(self, cache: DetectionCache = None) -> None:
+        self.cache = cache
+        self._local = local()
+
+    def load_image(self):
+        # the scheduler may run several threads on one Start, each keeps its own preallocated buffers
+        li = getattr(self._local, 'li', None)
+        if li is None:
+            li = self._local.li = LoadImage()
+        return li
+
     def start_main(self, create_model: int = 0, image_path: str = "example.jpg", threshold: float = 1.0,
-                   detection_class: str = 'all'):
-        labels = ["person", "bicycle", "car", "motorbike", "aeroplane", "bus", "train", "truck",
-                  "boat", "traffic light", "fire hydrant", "stop sign", "parking meter", "bench",
-                  "bird", "cat", "dog", "horse", "sheep", "cow", "elephant", "bear", "zebra", "giraffe",
-                  "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee", "skis", "snowboard",
-                  "sports ball", "kite", "baseball bat", "baseball glove", "skateboard", "surfboard",
-                  "tennis racket", "bottle", "wine glass", "cup", "fork", "knife", "spoon", "bowl", "banana",
-                  "apple", "sandwich", "orange", "broccoli", "carrot", "hot dog", "pizza", "donut", "cake",
-                  "chair", "sofa", "pottedplant", "bed", "diningtable", "toilet", "tvmonitor", "laptop", "mouse",
-                  "remote", "keyboard", "cell phone", "microwave", "oven", "toaster", "sink", "refrigerator",
-                  "book", "clock", "vase", "scissors", "teddy bear", "hair drier", "toothbrush"]
-        net_h, net_w = 416, 416
-        obj_thresh, nms_thresh = 0.5, 0.45
-        anchors = [[116, 90, 156, 198, 373, 326], [30, 61, 62, 45, 59, 119], [10, 13, 16, 30, 33, 23]]
+                   detection_class: str = 'all', net_size=None, trace: Trace = None):
+        trace = trace or Trace()
         try:
             if create_model == 1:
-                cm = CreateModel()
-            yolov3 = load_model('model.h5')
-            input_w, input_h = 416, 416
-            photo_filename = image_path
-            li = LoadImage()
-            image, image_w, image_h = li.load_image_pixels(photo_filename, (input_w, input_h))
-            if image_w != image_h:
-                return "502"
-            yolos = yolov3.predict(image)
-            class_threshold = threshold
-            boxes = list()
-            dt = DetectObject()
-            for i in range(len(yolos)):
-                boxes += dt.decode_netout(yolos[i][0], anchors[i], obj_thresh, net_h, net_w)
-
-            dt.correct_yolo_boxes(boxes, image_h, image_w, net_h, net_w)
-            dt.do_nms(boxes, nms_thresh)
-            v_boxes, v_labels, v_scores = dt.get_boxes(boxes, labels, class_threshold)
-            im = Image.open(photo_filename)
-            dpi = im.info['dpi']
-            if dpi[0] < 400:
-                dpi = (400, 400)
-            dt.draw_boxes(photo_filename, v_boxes, v_labels, v_scores, detection_class, dpi)
-            return "200"
+                with trace.stage('create_model'):
+                    cm = CreateModel()
+                    ModelRegistry().reload()
         except FileNotFoundError as ErrFile:
             return "404"
         except BaseException as Err:
-            print(Err)
+            print(trace.id, Err)
             return "500"
+        return self.start_batch([image_path], threshold, detection_class, net_size=net_size, traces=[trace])[0]
+
+    def start_batch(self, image_paths: list, threshold=1.0, detection_class='all', batch_size: int = None,
+                    render=True, net_size=None, traces: list = None, net_sizes: list = None,
+                    detection_classes: list = None):
+        return [result['status'] for result in self.detect_batch(image_paths, threshold, detection_class, batch_size,
+                                                                 render, net_size, traces, net_sizes,
+                                                                 detection_classes)]
+
+    def net_shape(self, net_size=None):
+        if net_size is None:
+            return self.NET_W, self.NET_H
+        net_w, net_h = (net_size, net_size) if isinstance(net_size, int) else tuple(net_size)
+        if net_w <= 0 or net_h <= 0 or net_w % 32 or net_h % 32:
+            raise ValueError("network input size must be a positive multiple of 32, got " + str(net_size))
+        if net_w > self.MAX_NET_SIZE or net_h > self.MAX_NET_SIZE:
+            raise ValueError("network input size must not exceed " + str(self.MAX_NET_SIZE) + ", got " +
+                             str(net_size))
+        return int(net_w), int(net_h)
+
+    def detect_batch(self, images: list, threshold=1.0, detection_class='all', batch_size: int = None,
+                     render=True, net_size=None, traces: list = None, net_sizes: list = None,
+                     detection_classes: list = None):
+        # net_size and detection_class apply to every image, even as lists ([w, h], ['car', 'bus']);
+        # per-image values go in net_sizes and detection_classes
+        batch_size = batch_size or self.BATCH_SIZE
+        thresholds = threshold if isinstance(threshold, (list, tuple)) else [threshold] * len(images)
+        classes = detection_classes if detection_classes is not None else [detection_class] * len(images)
+        if len(classes) != len(images):
+            raise ValueError("got " + str(len(classes)) + " detection classes for " + str(len(images)) + " images")
+        class_ids = [None] * len(images)
+        renders = render if isinstance(render, (list, tuple)) else [render] * len(images)
+        net_sizes = net_sizes if net_sizes is not None else [net_size] * len(images)
+        if len(net_sizes) != len(images):
+            raise ValueError("got " + str(len(net_sizes)) + " network sizes for " + str(len(images)) + " images")
+        traces = traces or [Trace() for image in images]
+        results = [{'status': "500", 'detections': Detections(), 'trace_id': trace.id, 'timings': trace.timings}
+                   for trace in traces]
+        li = self.load_image()
+        groups = {}
+        for i in range(len(images)):
+            try:
+                class_ids[i] = self.class_ids(classes[i])
+                groups.setdefault(self.net_shape(net_sizes[i]), []).append(i)
+            except (ValueError, TypeError) as Err:
+                print(traces[i].id, Err)
+                results[i]['status'] = "400"
+        for shape, indices in groups.items():
+            try:
+                predict = ModelRegistry().get_predictor(shape)
+            except BaseException as Err:
+                print(Err)
+                continue
+            version = ModelRegistry().version() + ':' + str(shape[0]) + 'x' + str(shape[1])
+            pixels = li.get_buffer(shape, min(batch_size, len(indices)))
+            for first in range(0, len(indices), batch_size):
+                self._detect_chunk(li, pixels, predict, shape, version, images, indices[first:first + batch_size],
+                                   thresholds, class_ids, renders, results, traces)
+        return results
+
+    def _detect_chunk(self, li, pixels, predict, shape, version, images, indices, thresholds, class_ids, renders,
+                      results, traces):
+        entries, yolos, count = [], None, 0
+        for i in indices:
+            render_image = renders[i] and not isinstance(images[i], bytes)
+            start = time.perf_counter()
+            try:
+                source, key, cached, image, slot, netouts = images[i], None, None, None, None, None
+                if self.cache is not None:
+                    if not isinstance(source, bytes):
+                        with open(source, 'rb') as image_file:
+                            source = image_file.read()
+                    key = self.cache.key(source, version)
+                    cached = self.cache.get(key)
+                if cached is not None:
+                    netouts, image_w, image_h = cached
+                    if render_image:
+                        image, image_w, image_h = li.decode_image(source)
+                else:
+                    # images that get annotated are decoded at native resolution and kept for drawing
+                    image, image_w, image_h = li.decode_image(source, None if render_image else shape)
+                    li.letterbox(image, image_w, image_h, shape, pixels[count])
+                    slot = count
+                    count += 1
+            except FileNotFoundError as ErrFile:
+                results[i]['status'] = "404"
+                continue
+            except BaseException as Err:
+                print(traces[i].id, Err)
+                continue
+            finally:
+                traces[i].add('load', time.perf_counter() - start)
+            entries.append((i, key, slot, netouts, image_w, image_h, image if render_image else None))
+        if count:
+            start = time.perf_counter()
+            try:
+                yolos = [yolo.numpy() for yolo in predict(pixels[:count])]
+            except BaseException as Err:
+                print([traces[entry[0]].id for entry in entries if entry[2] is not None], Err)
+            elapsed = time.perf_counter() - start
+            for entry in entries:
+                if entry[2] is not None:
+                    traces[entry[0]].add('predict', elapsed)
+        for i, key, slot, netouts, image_w, image_h, image in entries:
+            if slot is not None:
+                if yolos is None:
+                    continue
+                netouts = [yolo[slot] for yolo in yolos]
+            try:
+                if slot is not None and key is not None:
+                    self.cache.put(key, netouts, image_w, image_h)
+                results[i]['detections'] = self.get_detections(netouts, image_w, image_h, thresholds[i], shape,
+                                                               traces[i], class_ids[i])
+                if image is not None:
+                    with traces[i].stage('draw'):
+                        self.draw_detections(images[i], results[i]['detections'], image)
+                results[i]['status'] = "200"
+            except FileNotFoundError as ErrFile:
+                results[i]['status'] = "404"
+            except BaseException as Err:
+                print(traces[i].id, Err)
+
+    def get_candidates(self, netouts, image_w, image_h, shape=None, trace: Trace = None, class_ids=None):
+        net_w, net_h = shape or (self.NET_W, self.NET_H)
+        trace = trace or Trace()
+        dt = DetectObject()
+        with trace.stage('decode'):
+            decoded = [dt.decode_netout_arrays(netouts[i], self.ANCHORS[i], self.OBJ_THRESH, net_h, net_w, class_ids)
+                       for i in range(len(netouts))]
+            coords = np.concatenate([part[0] for part in decoded])
+            objectness = np.concatenate([part[1] for part in decoded])
+            classes = np.concatenate([part[2] for part in decoded])
+        with trace.stage('correct'):
+            coords = dt.correct_yolo_coords(coords, image_h, image_w, net_h, net_w)
+        return coords, objectness, classes
+
+    def get_detections(self, netouts, image_w, image_h, threshold, shape=None, trace: Trace = None, class_ids=None):
+        trace = trace or Trace()
+        dt = DetectObject()
+        coords, objectness, classes = self.get_candidates(netouts, image_w, image_h, shape, trace, class_ids)
+        with trace.stage('nms'):
+            dt.nms_arrays(coords, classes, self.NMS_THRESH)
+        with trace.stage('filter'):
+            return dt.select_detections(coords, objectness, classes, threshold, class_ids)
+
+    def tile_origins(self, length, tile_size, overlap):
+        if length <= tile_size:
+            return [0]
+        origins = list(range(0, length - tile_size, tile_size - overlap))
+        return origins + [length - tile_size]
+
+    def active_tiles(self, image, tiles, tile_size, previous=None, class_ids=None):
+        # a reduced greyscale copy is enough to tell flat or unchanged tiles from ones worth a model pass
+        grey = np.asarray(image.convert('L').reduce(self.TILE_REDUCE), dtype='float32')
+        if previous is not None and (previous['shape'] != grey.shape or
+                                     not np.array_equal(previous['class_ids'], class_ids)):
+            previous = None
+        active, reused = [], {}
+        for x, y in tiles:
+            region = (slice(y // self.TILE_REDUCE, (y + tile_size) // self.TILE_REDUCE),
+                      slice(x // self.TILE_REDUCE, (x + tile_size) // self.TILE_REDUCE))
+            patch = grey[region]
+            if patch.size == 0 or patch.std() < self.TILE_MIN_STD:
+                continue
+            # compare against the patch the kept candidates were computed on, so slow changes still add up
+            entry = previous['tiles'].get((x, y)) if previous is not None else None
+            if entry is not None and entry['age'] < self.TILE_MAX_REUSE and \
+                    np.abs(patch - entry['patch']).mean() < self.TILE_MIN_MOTION:
+                reused[(x, y)] = dict(entry, age=entry['age'] + 1)
+                continue
+            active.append((x, y, patch.copy()))
+        return active, reused, grey.shape
+
+    def tile_shape(self, tile_size: int = None, overlap: int = None):
+        tile_size = tile_size or self.TILE_SIZE
+        overlap = self.TILE_OVERLAP if overlap is None else overlap
+        shape = self.net_shape(tile_size)
+        if not 0 <= overlap < tile_size:
+            raise ValueError("tile overlap must be in [0, " + str(tile_size) + "), got " + str(overlap))
+        return tile_size, overlap, shape
+
+    def detect_tiled(self, image, threshold=1.0, detection_class='all', tile_size: int = None, overlap: int = None,
+                     render=False, previous: dict = None, trace: Trace = None):
+        trace = trace or Trace()
+        result = {'status': "500", 'detections': Detections(), 'trace_id': trace.id, 'timings': trace.timings,
+                  'tiles': 0, 'skipped_tiles': 0, 'reference': None}
+        source = image
+        try:
+            tile_size, overlap, shape = self.tile_shape(tile_size, overlap)
+            class_ids = self.class_ids(detection_class)
+            li = self.load_image()
+            dt = DetectObject()
+            with trace.stage('load'):
+                if isinstance(image, np.ndarray):
+                    image = Image.fromarray(image)
+                elif not isinstance(image, Image.Image):
+                    image = li.decode_image(image)[0]
+                image_w, image_h = image.size
+                tiles = [(x, y) for y in self.tile_origins(image_h, tile_size, overlap)
+                         for x in self.tile_origins(image_w, tile_size, overlap)]
+                active, kept, grey_shape = self.active_tiles(image, tiles, tile_size, previous, class_ids)
+            if active:
+                predict = ModelRegistry().get_predictor(shape)
+                pixels = li.get_buffer(shape, min(self.BATCH_SIZE, len(active)))
+            for first in range(0, len(active), self.BATCH_SIZE):
+                chunk = active[first:first + self.BATCH_SIZE]
+                with trace.stage('load'):
+                    for k, (x, y, patch) in enumerate(chunk):
+                        crop = image.crop((x, y, min(x + tile_size, image_w), min(y + tile_size, image_h)))
+                        li.letterbox(crop, crop.width, crop.height, shape, pixels[k])
+                with trace.stage('predict'):
+                    yolos = [yolo.numpy() for yolo in predict(pixels[:len(chunk)])]
+                for k, (x, y, patch) in enumerate(chunk):
+                    coords, objectness, classes = self.get_candidates(
+                        [yolo[k] for yolo in yolos], min(tile_size, image_w - x), min(tile_size, image_h - y),
+                        shape, trace, class_ids)
+                    # shift the tile's boxes back into the coordinates of the full image
+                    kept[(x, y)] = {'candidates': (coords + [x, y, x, y], objectness, classes), 'patch': patch,
+                                    'age': 0}
+            parts = [entry['candidates'] for entry in kept.values()]
+            coords = np.concatenate([part[0] for part in parts]) if parts else np.empty((0, 4))
+            objectness = np.concatenate([part[1] for part in parts]) if parts else np.empty(0)
+            width = len(self.LABELS) if class_ids is None else len(class_ids)
+            classes = np.concatenate([part[2] for part in parts]) if parts else np.empty((0, width))
+            with trace.stage('nms'):
+                # per-class passes merge the copies of an object seen by overlapping tiles without an IoU matrix
+                # across classes; concatenate copied the scores, so the candidates kept per tile stay untouched
+                dt.nms_arrays(coords, classes, self.NMS_THRESH)
+            with trace.stage('filter'):
+                result['detections'] = dt.select_detections(coords, objectness, classes, threshold, class_ids)
+            if render and isinstance(source, str):
+                with trace.stage('draw'):
+                    self.draw_detections(source, result['detections'], image)
+            result.update({'status': "200", 'tiles': len(tiles), 'skipped_tiles': len(tiles) - len(active),
+                           'reference': {'shape': grey_shape, 'tiles': kept, 'class_ids': class_ids}})
+        except FileNotFoundError as ErrFile:
+            result['status'] = "404"
+        except ValueError as Err:
+            print(trace.id, Err)
+            result['status'] = "400"
+        except BaseException as Err:
+            print(trace.id, Err)
+        return result
+
+    def class_ids(self, detection_class):
+        # a group name, a label, comma separated labels or a list of labels and label ids; None keeps every class
+        if detection_class is None:
+            return None
+        if isinstance(detection_class, str):
+            detection_class = self.CLASS_GROUPS.get(detection_class, detection_class.split(','))
+        ids = set()
+        for name in detection_class:
+            name = name.strip() if isinstance(name, str) else name
+            if isinstance(name, str) and name in self.CLASS_GROUPS:
+                ids.update(self.LABELS.index(label) for label in self.CLASS_GROUPS[name])
+            elif isinstance(name, str) and name in self.LABELS:
+                ids.add(self.LABELS.index(name))
+            elif isinstance(name, (int, np.integer)) and 0 <= name < len(self.LABELS):
+                ids.add(int(name))
+            else:
+                raise ValueError("unknown detection class " + repr(name))
+        return np.array(sorted(ids), dtype=int)
+
+    def format_detections(self, detections: Detections):
+        return detections.to_json(self.LABELS)
+
+    def draw_detections(self, photo_filename, detections: Detections, image=None):
+        if image is None:
+            image = Image.open(photo_filename).convert('RGB')
+        dpi = image.info.get('dpi', (400, 400))
+        if dpi[0] < 400:
+            dpi = (400, 400)
+        return DetectObject().draw_detections(photo_filename, detections, self.LABELS, dpi, image,
+                                              self.RENDER_FORMAT, self.RENDER_QUALITY)
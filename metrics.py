@@ -0,0 +1,168 @@
+import cProfile
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+
+
+class Trace:
+
+    def __init__(self, trace_id: str = None) -> None:
+        self.id = trace_id or uuid.uuid4().hex[:16]
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+class Metrics:
+    LATENCY_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, buckets=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                buckets = tuple(buckets or self.LATENCY_BUCKETS)
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                     'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def drain(self):
+        # everything recorded since the last drain, for a process whose registry is never scraped itself
+        with self._lock:
+            snapshot = {'counters': self._counters, 'gauges': dict(self._gauges), 'histograms': self._histograms}
+            self._counters, self._histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot: dict, **labels):
+        extra = tuple(labels.items())
+        with self._lock:
+            for (name, key_labels), value in snapshot['counters'].items():
+                key = (name, tuple(sorted(key_labels + extra)))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for (name, key_labels), value in snapshot['gauges'].items():
+                self._gauges[(name, tuple(sorted(key_labels + extra)))] = value
+            for (name, key_labels), histogram in snapshot['histograms'].items():
+                key = (name, tuple(sorted(key_labels + extra)))
+                merged = self._histograms.get(key)
+                if merged is None:
+                    merged = self._histograms[key] = {'buckets': histogram['buckets'],
+                                                      'counts': [0] * len(histogram['buckets']), 'sum': 0.0,
+                                                      'count': 0}
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+                merged['sum'] += histogram['sum']
+                merged['count'] += histogram['count']
+
+    def record_result(self, result: dict, latency: float):
+        self.inc('yolo_requests_total', status=result['status'])
+        self.observe('yolo_request_latency_seconds', latency)
+        self.observe('yolo_detections_per_request', len(result.get('detections', [])), self.COUNT_BUCKETS)
+        for stage, seconds in result.get('timings', {}).items():
+            self.observe('yolo_stage_seconds', seconds, stage=stage)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({key[0] for key in values}):
+                    lines.append('# TYPE ' + name + ' ' + kind)
+                    for key in sorted(key for key in values if key[0] == name):
+                        lines.append(name + self._labels(key[1]) + ' ' + repr(float(values[key])))
+            for name in sorted({key[0] for key in self._histograms}):
+                lines.append('# TYPE ' + name + ' histogram')
+                for key in sorted(key for key in self._histograms if key[0] == name):
+                    histogram = self._histograms[key]
+                    for bound, count in zip(histogram['buckets'], histogram['counts']):
+                        lines.append(name + '_bucket' + self._labels(key[1] + (('le', repr(float(bound))),)) +
+                                     ' ' + str(count))
+                    lines.append(name + '_bucket' + self._labels(key[1] + (('le', '+Inf'),)) + ' ' +
+                                 str(histogram['count']))
+                    lines.append(name + '_sum' + self._labels(key[1]) + ' ' + repr(histogram['sum']))
+                    lines.append(name + '_count' + self._labels(key[1]) + ' ' + str(histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in labels) + '}'
+
+
+METRICS = Metrics()
+
+
+class MetricsServer:
+
+    def __init__(self, port: int, metrics: Metrics = METRICS, host: str = '127.0.0.1') -> None:
+        metrics_ = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics_.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print("METRICS ON PORT " + str(self.httpd.server_address[1]))
+        return self
+
+
+class Profiler:
+
+    def __init__(self, sample_rate: float = 0.0, output_dir: str = 'profiles') -> None:
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+
+    def run(self, name: str, func, *args, **kwargs):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return func(*args, **kwargs)
+        os.makedirs(self.output_dir, exist_ok=True)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.dump_stats(os.path.join(self.output_dir, name + '.prof'))
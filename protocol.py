@@ -0,0 +1,47 @@
+import json
+import struct
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE: int = 64 * 1024 * 1024
+
+
+# frame:   [u32 payload length][payload]
+# request: [u32 header length][utf-8 json header][image bytes, may be empty]
+# response: [u32 header length][utf-8 json header][binary detections, may be empty]
+def encode_frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    size, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > max_size:
+        raise ValueError("frame of " + str(size) + " bytes exceeds limit of " + str(max_size))
+    return await reader.readexactly(size)
+
+
+def encode_request(header: dict, image: bytes = b'') -> bytes:
+    header = json.dumps(header).encode('utf-8')
+    return encode_frame(FRAME_HEADER.pack(len(header)) + header + image)
+
+
+def decode_request(payload: bytes):
+    if len(payload) < FRAME_HEADER.size:
+        raise ValueError("frame of " + str(len(payload)) + " bytes has no header length")
+    size, = FRAME_HEADER.unpack_from(payload)
+    if FRAME_HEADER.size + size > len(payload):
+        raise ValueError("header of " + str(size) + " bytes does not fit in a frame of " + str(len(payload)))
+    header = json.loads(payload[FRAME_HEADER.size:FRAME_HEADER.size + size].decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError("header must be a json object")
+    return header, payload[FRAME_HEADER.size + size:]
+
+
+def encode_response(response: dict, body=()) -> list:
+    # returned as a list of buffers for writer.writelines so the body is never copied into one frame
+    header = json.dumps(response).encode('utf-8')
+    size = FRAME_HEADER.size + len(header) + sum(memoryview(buffer).nbytes for buffer in body)
+    return [FRAME_HEADER.pack(size), FRAME_HEADER.pack(len(header)), header] + list(body)
+
+
+def decode_response(payload: bytes):
+    return decode_request(payload)
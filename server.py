@@ -1,28 +1,144 @@
+import queue
 import socket
-from threading import Thread
+import time
+from concurrent.futures import Future
+from threading import Thread, Lock
 import main as imageRecognize
+from detections import Detections
+from metrics import METRICS, MetricsServer, Profiler, Trace
+from worker_pool import WorkerPool
 
 
-def client_handler(conn, startClass: imageRecognize.Start):
+def collect_batch(requests, max_batch_size: int, max_wait_ms: float):
+    batch = [requests.get()]
+    deadline = time.monotonic() + max_wait_ms / 1000.
+    while len(batch) < max_batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(requests.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+
+class InferenceScheduler:
+
+    def __init__(self, startClass: imageRecognize.Start, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 workers: int = 1, profiler: Profiler = None) -> None:
+        self.startClass = startClass
+        self.profiler = profiler or Profiler()
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue()
+        self._stats_lock = Lock()
+        self._stats = {'requests': 0, 'batches': 0, 'max_queue_depth': 0, 'batch_sizes': {}}
+        for i in range(workers):
+            Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, create_model: int, image, threshold: float, detection_class: str,
+               render: bool = True, net_size=None) -> Future:
+        future = Future()
+        self.requests.put((future, create_model, image, threshold, detection_class, render, net_size, Trace(),
+                           time.perf_counter()))
+        depth = self.requests.qsize()
+        METRICS.set('yolo_queue_depth', depth)
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], depth)
+        return future
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats, batch_sizes=dict(self._stats['batch_sizes']))
+        stats['queue_depth'] = self.requests.qsize()
+        stats['mean_batch_size'] = (sum(size * count for size, count in stats['batch_sizes'].items())
+                                    / stats['batches']) if stats['batches'] else 0.0
+        return stats
+
+    def _worker(self):
+        while True:
+            batch = collect_batch(self.requests, self.max_batch_size, self.max_wait_ms)
+            with self._stats_lock:
+                self._stats['batches'] += 1
+                self._stats['batch_sizes'][len(batch)] = self._stats['batch_sizes'].get(len(batch), 0) + 1
+            print("BATCH " + str(len(batch)) + " QUEUE " + str(self.requests.qsize()))
+            METRICS.observe('yolo_batch_size', len(batch), METRICS.COUNT_BUCKETS)
+            METRICS.set('yolo_queue_depth', self.requests.qsize())
+            started = time.perf_counter()
+            for request in batch:
+                request[7].add('queue_wait', started - request[8])
+            # model rebuilds are rare and run on their own before the rest of the batch
+            for request in batch:
+                if request[1] == 1:
+                    status = self.startClass.start_main(*request[1:5], net_size=request[6], trace=request[7])
+                    self._finish(request, {'status': status, 'detections': Detections(), 'trace_id': request[7].id,
+                                           'timings': request[7].timings})
+            batch = [request for request in batch if request[1] != 1]
+            if not batch:
+                continue
+            try:
+                results = self.profiler.run(batch[0][7].id, self.startClass.detect_batch,
+                                            [request[2] for request in batch], [request[3] for request in batch],
+                                            batch_size=len(batch), render=[request[5] for request in batch],
+                                            traces=[request[7] for request in batch],
+                                            net_sizes=[request[6] for request in batch],
+                                            detection_classes=[request[4] for request in batch])
+            except BaseException as Err:
+                print([request[7].id for request in batch], Err)
+                results = [{'status': "500", 'detections': Detections(), 'trace_id': request[7].id,
+                            'timings': request[7].timings} for request in batch]
+            for request, res in zip(batch, results):
+                self._finish(request, res)
+
+    def _finish(self, request, result):
+        METRICS.record_result(result, time.perf_counter() - request[8])
+        request[0].set_result(result)
+
+
+def create_scheduler(server):
+    # both socket servers configure their scheduler through the same class attributes
+    if server.PROCESS_WORKERS > 0:
+        return WorkerPool(server.PROCESS_WORKERS, server.MAX_BATCH_SIZE, server.MAX_WAIT_MS,
+                          profile_sample_rate=server.PROFILE_SAMPLE_RATE)
+    imageRecognize.ModelRegistry().get_model()
+    print(imageRecognize.ModelRegistry().metrics())
+    return InferenceScheduler(server.startClass, server.MAX_BATCH_SIZE, server.MAX_WAIT_MS,
+                              server.INFERENCE_WORKERS, Profiler(server.PROFILE_SAMPLE_RATE))
+
+
+def client_handler(conn, scheduler: InferenceScheduler):
     while True:
         data = conn.recv(1024)
         if not data:
             break
-        params = str(data.decode(encoding='utf-16')).split("$$") #example: 0$$images/road-1.png$$0.98$$car
+        params = str(data.decode(encoding='utf-16')).split("$$") #example: 0$$images/road-1.png$$0.98$$car[$$608]
         print(params)
-        res = startClass.start_main(int(params[0]), params[1], float(params[2]), params[3])
+        net_size = int(params[4]) if len(params) > 4 else None
+        res = scheduler.submit(int(params[0]), params[1], float(params[2]), params[3], True,
+                               net_size).result()['status']
         print(res)
         conn.send(res.encode(encoding='utf-8'))
     conn.close()
 
 
 class ServerSocket:
-    startClass = imageRecognize.Start()
+    startClass = imageRecognize.Start(imageRecognize.DetectionCache())
     PORT: int = 9090
     MAX_QUEUE: int = 1
+    MAX_BATCH_SIZE: int = 8
+    MAX_WAIT_MS: float = 10
+    INFERENCE_WORKERS: int = 1
+    PROCESS_WORKERS: int = 0
+    METRICS_PORT: int = 9100
+    PROFILE_SAMPLE_RATE: float = 0.0
 
     def __init__(self) -> None:
         print("INIT SERVER")
+        self.scheduler = create_scheduler(self)
+        if self.METRICS_PORT:
+            MetricsServer(self.METRICS_PORT).start()
 
     def start_listen(self):
         sock = socket.socket()
@@ -31,7 +147,7 @@ class ServerSocket:
         print("SERVER IS START")
         while True:
             conn, addr = sock.accept()
-            th = Thread(target=client_handler, args=(conn, self.startClass,))
+            th = Thread(target=client_handler, args=(conn, self.scheduler,))
             th.start()
         print("SERVER CLOSE")
 
@@ -39,4 +155,4 @@ class ServerSocket:
 if __name__ == "__main__":
     serv = ServerSocket()
     th = Thread(target=serv.start_listen())
-    th.start()
\ No newline at end of file
+    th.start()
@@ -0,0 +1,193 @@
+import os
+import queue
+import time
+from threading import Event, Thread
+import numpy as np
+import main as imageRecognize
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class FrameStream:
+    POLL_INTERVAL: float = 0.1
+
+    def __init__(self, source: str, batch_size: int = 4, frame_step: int = 1, realtime: bool = False,
+                 threshold: float = 1.0, detection_class: str = 'all', prefetch: int = 8, net_size=None,
+                 tile: bool = False, tile_size: int = None, tile_overlap: int = None) -> None:
+        self.source = source
+        self.batch_size = batch_size
+        self.frame_step = max(1, frame_step)
+        self.realtime = realtime
+        self.threshold = threshold
+        self.detection_class = detection_class
+        self.net_size = net_size
+        self.tile = tile
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.frames = queue.Queue(maxsize=max(prefetch, batch_size))
+        self.processed = 0
+        self.skipped = 0
+        self.failed = 0
+        self._stop = Event()
+        self._thread = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def fps(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def read_frames(self):
+        if os.path.isdir(self.source):
+            for index, name in enumerate(sorted(os.listdir(self.source))):
+                if name.lower().endswith(imageRecognize.LoadImage.IMAGE_EXTENSIONS):
+                    yield index, os.path.join(self.source, name), None
+            return
+        if cv2 is None:
+            raise ImportError("opencv-python is required to read video files")
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            raise FileNotFoundError(self.source)
+        index = 0
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield index, None, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                index += 1
+        finally:
+            capture.release()
+
+    def _put(self, item, drop: bool = False):
+        # a consumer that stopped early never takes another frame, so the wait has to end with it
+        while not self._stop.is_set():
+            try:
+                self.frames.put(item, timeout=self.POLL_INTERVAL)
+                return
+            except queue.Full:
+                if drop:
+                    # keep pace with the source: drop the oldest waiting frame instead of blocking
+                    try:
+                        self.frames.get_nowait()
+                        self.skipped += 1
+                    except queue.Empty:
+                        pass
+
+    def _prefetch(self, shape):
+        li = imageRecognize.LoadImage()
+        frames = self.read_frames()
+        try:
+            for index, path, frame in frames:
+                if self._stop.is_set():
+                    return
+                if index % self.frame_step:
+                    self.skipped += 1
+                    continue
+                try:
+                    if self.tile:
+                        # tiles are cut from the full resolution frame, nothing is shrunk here
+                        image, image_w, image_h = li.decode_image(path) if path is not None else (frame, None, None)
+                    elif path is not None:
+                        image, image_w, image_h = li.load_image_pixels(path, shape)
+                    else:
+                        image, image_w, image_h = li.load_image_array(frame, shape)
+                except (OSError, ValueError) as Err:
+                    # one unreadable frame is counted and skipped, the rest of the stream goes on
+                    print(path or index, Err)
+                    self.failed += 1
+                    continue
+                self._put((index, path, image, image_w, image_h), self.realtime)
+        except BaseException as Err:
+            # the source itself failed: hand the error to the consumer instead of ending quietly
+            self._put(Err)
+            return
+        finally:
+            # releases the capture even when the consumer stopped early
+            frames.close()
+        self._put(None)
+
+    def __iter__(self):
+        startClass = imageRecognize.Start()
+        shape = startClass.net_shape(self.net_size)
+        # a bad class or tile size fails here, before any frame is read
+        class_ids = startClass.class_ids(self.detection_class)
+        if self.tile:
+            startClass.tile_shape(self.tile_size, self.tile_overlap)
+        if self._thread is not None:
+            # one reader per stream: an earlier pass is stopped before its queue is replaced
+            self._stop.set()
+            self._thread.join()
+            self.frames = queue.Queue(maxsize=self.frames.maxsize)
+        self._stop.clear()
+        self._thread = Thread(target=self._prefetch, args=(shape,), daemon=True)
+        self._thread.start()
+        self.started = time.perf_counter()
+        try:
+            if self.tile:
+                yield from self._iter_tiled(startClass)
+            else:
+                yield from self._iter_batched(startClass, shape, class_ids)
+        finally:
+            self._stop.set()
+
+    def _iter_batched(self, startClass, shape, class_ids):
+        predict = imageRecognize.ModelRegistry().get_predictor(shape)
+        done, error = False, None
+        while not done:
+            batch = [self.frames.get()]
+            while not self._is_end(batch[-1]) and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.frames.get_nowait())
+                except queue.Empty:
+                    break
+            if self._is_end(batch[-1]):
+                done = True
+                error = batch.pop()
+            if not batch:
+                continue
+            yolos = [yolo.numpy() for yolo in predict(np.concatenate([item[2] for item in batch]))]
+            for n, (index, path, image, image_w, image_h) in enumerate(batch):
+                detections = startClass.get_detections([yolo[n] for yolo in yolos], image_w, image_h,
+                                                       self.threshold, shape, class_ids=class_ids)
+                self.processed += 1
+                yield {'frame': index, 'path': path, 'detections': detections}
+        self._done(error)
+
+    def _iter_tiled(self, startClass):
+        reference = None
+        while True:
+            item = self.frames.get()
+            if self._is_end(item):
+                self._done(item)
+                return
+            index, path, image = item[:3]
+            result = startClass.detect_tiled(image, self.threshold, self.detection_class, self.tile_size,
+                                             self.tile_overlap, previous=reference)
+            if result['status'] == "404":
+                raise FileNotFoundError(path)
+            if result['status'] == "400":
+                raise ValueError("tiled detection rejected frame " + str(index))
+            if result['status'] != "200":
+                # a failed frame is not an empty one: count it and keep the last good reference
+                self.failed += 1
+                continue
+            reference = result['reference']
+            self.processed += 1
+            yield {'frame': index, 'path': path, 'detections': result['detections']}
+
+    def _is_end(self, item):
+        return item is None or isinstance(item, BaseException)
+
+    def _done(self, error=None):
+        self.finished = time.perf_counter()
+        print("STREAM DONE: %d frames, %d skipped, %d failed, %.2f fps" % (self.processed, self.skipped, self.failed,
+                                                                           self.fps))
+        if error is not None:
+            raise error
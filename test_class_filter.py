@@ -0,0 +1,58 @@
+import pytest
+from PIL import Image
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+CAR, BUS, PERSON = 2, 5, 0
+
+
+@pytest.fixture
+def scene(fake_model):
+    # a car, a bus and a person in three separate cells of every image
+    for col, label in ((2, CAR), (6, BUS), (10, PERSON)):
+        fake_model.add(6, col, label)
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / 'frame.png')
+    Image.new('RGB', (416, 416)).save(path)
+    return path
+
+
+def labels(result):
+    return sorted(result['detections'].label.tolist())
+
+
+def test_class_ids():
+    startClass = imageRecognize.Start()
+    assert startClass.class_ids('all').tolist() == [CAR, 3, BUS, 7]
+    assert startClass.class_ids('vehicles').tolist() == [CAR, 3, BUS, 7]
+    assert startClass.class_ids('car, person').tolist() == [PERSON, CAR]
+    assert startClass.class_ids(['vehicles', PERSON]).tolist() == [PERSON, CAR, 3, BUS, 7]
+    assert startClass.class_ids(None) is None
+    for unknown in ('spaceship', [99]):
+        with pytest.raises(ValueError):
+            startClass.class_ids(unknown)
+
+
+@pytest.mark.parametrize('count', [1, 3])
+def test_class_list_is_one_filter_for_every_image(scene, image_path, count):
+    results = imageRecognize.Start().detect_batch([image_path] * count, 0.5, ['car', 'bus'], render=False)
+    assert [labels(result) for result in results] == [[CAR, BUS]] * count
+
+
+def test_per_image_detection_classes(scene, image_path):
+    results = imageRecognize.Start().detect_batch([image_path] * 3, 0.5, render=False,
+                                                  detection_classes=[['car', 'bus'], 'person', 'spaceship'])
+    assert [result['status'] for result in results] == ["200", "200", "400"]
+    assert [labels(result) for result in results[:2]] == [[CAR, BUS], [PERSON]]
+
+
+def test_start_main_takes_a_class_list(scene, image_path, monkeypatch):
+    seen = []
+    startClass = imageRecognize.Start()
+    monkeypatch.setattr(startClass, 'draw_detections', lambda path, detections, image=None: seen.append(detections))
+    assert startClass.start_main(0, image_path, 0.5, ['car', 'bus']) == "200"
+    assert sorted(seen[0].label.tolist()) == [CAR, BUS]
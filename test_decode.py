@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+
+def one_cell(grid, row, col):
+    netout = np.full((grid, grid, 3, 85), -10, dtype='float32')
+    netout[row, col, 0, :4] = 0
+    netout[row, col, 0, 4] = 5
+    netout[row, col, 0, 5 + 2] = 5
+    return netout.reshape((grid, grid, 255))
+
+
+def test_centred_cell_decodes_to_the_image_centre():
+    dt = imageRecognize.DetectObject()
+    coords = dt.decode_netout_arrays(one_cell(13, 6, 6), [10, 10] * 3, 0.5, 416, 416)[0]
+    np.testing.assert_allclose((coords[:, :2] + coords[:, 2:]) / 2, [[0.5, 0.5]], atol=1e-6)
+
+
+def test_row_does_not_depend_on_the_column():
+    dt = imageRecognize.DetectObject()
+    for col in (0, 6, 12):
+        coords = dt.decode_netout_arrays(one_cell(13, 6, col), [10, 10] * 3, 0.5, 416, 416)[0]
+        assert coords[0, 1] + coords[0, 3] == pytest.approx(1.0)
+
+
+def test_centred_object_is_reported_at_the_centre_of_the_image():
+    netouts = [one_cell(13, 6, 6), np.full((26, 26, 255), -10, dtype='float32'),
+               np.full((52, 52, 255), -10, dtype='float32')]
+    detections = imageRecognize.Start().get_detections(netouts, 640, 480, 0.5, class_ids=np.array([2]))
+    xmin, ymin, xmax, ymax = detections.coords[0]
+    assert ((xmin + xmax) / 2, (ymin + ymax) / 2) == (pytest.approx(320, abs=1), pytest.approx(240, abs=1))
@@ -0,0 +1,36 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+from metrics import METRICS
+
+
+def netouts():
+    return [np.ones((13, 13, 255), dtype='float32'), np.ones((26, 26, 255), dtype='float32')]
+
+
+def test_disk_write_errors_are_contained(tmp_path, monkeypatch):
+    cache = imageRecognize.DetectionCache(cache_dir=str(tmp_path))
+
+    def full_disk(*args, **kwargs):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(np, 'savez', full_disk)
+    cache.put('key', netouts(), 640, 480)
+    assert cache.stats()['write_errors'] == 1
+    assert os.listdir(str(tmp_path)) == []
+    assert cache.get('key')[1:] == (640, 480)
+
+
+def test_lookups_are_exported_to_metrics(tmp_path):
+    cache = imageRecognize.DetectionCache(cache_dir=str(tmp_path))
+    assert cache.get('key') is None
+    cache.put('key', netouts(), 640, 480)
+    cache.get('key')
+    imageRecognize.DetectionCache(cache_dir=str(tmp_path)).get('key')
+    text = METRICS.render()
+    for result in ('hit', 'miss', 'disk_hit'):
+        assert 'yolo_cache_lookups_total{result="' + result + '"}' in text
+    assert 'yolo_cache_bytes' in text and 'yolo_cache_entries' in text
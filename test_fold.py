@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(ROOT, 'model.h5')
+IMAGES = os.path.join(ROOT, 'images')
+
+
+def sample_images():
+    image_paths = [os.path.join(IMAGES, name) for name in sorted(os.listdir(IMAGES))
+                   if name.lower().endswith(imageRecognize.LoadImage.IMAGE_EXTENSIONS)]
+    assert image_paths
+    return image_paths
+
+
+def test_folded_random_batchnorm_matches_heads_on_sample_images():
+    cm = imageRecognize.CreateModel(make=False)
+    model = cm.build_yolov3_model()
+    rng = np.random.default_rng(0)
+    for layer in model.layers:
+        if layer.name.startswith('bnorm_'):
+            size = layer.weights[0].shape[0]
+            layer.set_weights([rng.uniform(0.5, 1.5, size), rng.normal(0, 0.1, size), rng.normal(0, 0.1, size),
+                               rng.uniform(0.5, 2.0, size)])
+    folded = cm.fold_batchnorm(model)
+    assert not [layer.name for layer in folded.layers if layer.name.startswith('bnorm_')]
+    assert cm.check_folded(model, folded, sample_images()) < 1e-3
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason="model.h5 has not been built")
+def test_folded_model_matches_heads_on_sample_images():
+    cm = imageRecognize.CreateModel(make=False)
+    model = imageRecognize.load_model(MODEL_PATH)
+    folded = cm.fold_batchnorm(model)
+    assert cm.check_folded(model, folded, sample_images()) < 1e-3
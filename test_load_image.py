@@ -0,0 +1,31 @@
+from threading import Thread
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+
+def test_get_buffer_reuses_one_buffer_per_shape():
+    li = imageRecognize.LoadImage()
+    full = li.get_buffer((416, 416), 8)
+    assert full.shape == (8, 416, 416, 3)
+    assert np.shares_memory(li.get_buffer((416, 416), 3), full) and len(li.get_buffer((416, 416), 3)) == 3
+    for size in range(1, li.MAX_BUFFERS + 1):
+        li.get_buffer((32 * size, 32), 1)
+    assert not np.shares_memory(li.get_buffer((416, 416), 1), full)
+
+
+def test_batches_reuse_the_buffer_of_their_thread(fake_model, tmp_path):
+    path = str(tmp_path / 'frame.png')
+    Image.new('RGB', (96, 64)).save(path)
+    startClass = imageRecognize.Start()
+    startClass.detect_batch([path] * 2, 0.5, render=False)
+    startClass.detect_batch([path], 0.5, render=False)
+    other = Thread(target=startClass.detect_batch, args=([path], 0.5), kwargs={'render': False})
+    other.start()
+    other.join()
+    first, second, third = [pixels for shape, pixels in fake_model.calls]
+    assert np.shares_memory(first, second)
+    assert not np.shares_memory(first, third)
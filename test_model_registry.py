@@ -0,0 +1,23 @@
+import os
+import pytest
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+
+def touch(path, mtime):
+    with open(path, 'wb'):
+        pass
+    os.utime(path, (mtime, mtime))
+
+
+def test_default_model_prefers_fresh_weight_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    registry = imageRecognize.ModelRegistry()
+    touch('model.h5', 1000)
+    assert registry.model_path() == 'model.h5'
+    touch('model.wcache', 2000)
+    assert registry.model_path() == 'model.wcache'
+    touch('model.h5', 3000)
+    assert registry.model_path() == 'model.h5'
+    assert registry.model_path('other.h5') == 'other.h5'
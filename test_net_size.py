@@ -0,0 +1,75 @@
+import pytest
+from PIL import Image
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / 'frame.png')
+    Image.new('RGB', (96, 64)).save(path)
+    return path
+
+
+def test_net_shape_limits():
+    startClass = imageRecognize.Start()
+    assert startClass.net_shape(None) == (416, 416)
+    assert startClass.net_shape([320, 256]) == (320, 256)
+    for net_size in (0, 400, 32000, [32, 32000]):
+        with pytest.raises(ValueError):
+            startClass.net_shape(net_size)
+
+
+@pytest.mark.parametrize('count', [1, 3])
+def test_net_size_list_is_one_shape_for_every_image(fake_model, image_path, count):
+    results = imageRecognize.Start().detect_batch([image_path] * count, 0.5, net_size=[320, 256], render=False)
+    assert [result['status'] for result in results] == ["200"] * count
+    assert [shape for shape, pixels in fake_model.calls] == [(320, 256)]
+
+
+def test_per_image_net_sizes(fake_model, image_path):
+    results = imageRecognize.Start().detect_batch([image_path] * 3, 0.5, render=False,
+                                                  net_sizes=[320, [320, 256], 32000])
+    assert [result['status'] for result in results] == ["200", "200", "400"]
+    assert sorted(shape for shape, pixels in fake_model.calls) == [(320, 256), (320, 320)]
+
+
+def test_warmup_traces_the_request_predictor(monkeypatch, tmp_path):
+    calls = []
+    model_path = str(tmp_path / 'model.h5')
+    open(model_path, 'wb').close()
+    monkeypatch.setattr(imageRecognize, 'load_model', lambda path: lambda images, training: calls.append(images.shape))
+    registry = imageRecognize.ModelRegistry()
+    registry.get_model(model_path)
+    assert [tuple(shape)[1:] for shape in calls] == [(416, 416, 3)]
+    assert (model_path, (416, 416)) in registry._predictors
+
+
+def test_predictors_are_evicted_least_recently_used(monkeypatch):
+    monkeypatch.setattr(imageRecognize.ModelRegistry, '_predictors', imageRecognize.OrderedDict())
+    monkeypatch.setattr(imageRecognize.ModelRegistry, 'MAX_PREDICTORS', 3)
+    monkeypatch.setattr(imageRecognize.ModelRegistry, 'get_model', lambda self, model_path=None: None)
+    monkeypatch.setattr(imageRecognize.ModelRegistry, '_trace', lambda self, model, shape: tuple(shape))
+    registry = imageRecognize.ModelRegistry()
+    for size in (416, 320, 416, 352, 416, 384):
+        registry.get_predictor((size, size), 'model.h5')
+    assert [key[1][0] for key in registry._predictors] == [352, 416, 384]
+
+
+class RebuildStart:
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def start_main(self, *args, net_size=None, trace=None):
+        self.calls.append((args, net_size))
+        return "200"
+
+
+def test_model_rebuild_keeps_the_requested_net_size():
+    from server import InferenceScheduler
+    startClass = RebuildStart()
+    scheduler = InferenceScheduler(startClass)
+    assert scheduler.submit(1, 'example.jpg', 0.5, 'car', True, 320).result(5)['status'] == "200"
+    assert startClass.calls == [((1, 'example.jpg', 0.5, 'car'), 320)]
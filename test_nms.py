@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+
+def reference_nms(dt, boxes, nms_thresh):
+    # the per-class suppression loop DetectObject.do_nms used before it was vectorized
+    for c in range(len(boxes[0].classes)):
+        sorted_indices = np.argsort([-box.classes[c] for box in boxes])
+        for i in range(len(sorted_indices)):
+            index_i = sorted_indices[i]
+            if boxes[index_i].classes[c] == 0:
+                continue
+            for j in range(i + 1, len(sorted_indices)):
+                index_j = sorted_indices[j]
+                if dt.bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
+                    boxes[index_j].classes[c] = 0
+
+
+def random_scene(rng, count, classes, integer):
+    xy = rng.uniform(0, 200, (count, 2))
+    wh = rng.uniform(5, 80, (count, 2))
+    coords = np.concatenate([xy, xy + wh], axis=1)
+    if integer:
+        coords = np.floor(coords)
+    scores = rng.uniform(0, 1, (count, classes))
+    scores *= scores > 0.6
+    return coords, scores
+
+
+@pytest.mark.parametrize('integer', [True, False])
+@pytest.mark.parametrize('batched', [False, True])
+def test_nms_arrays_matches_per_class_loop(integer, batched):
+    dt = imageRecognize.DetectObject()
+    rng = np.random.default_rng(0)
+    for scene in range(20):
+        coords, scores = random_scene(rng, 60, 5, integer)
+        boxes = [imageRecognize.BoundBox(*coords[i], classes=scores[i].copy()) for i in range(len(coords))]
+        reference_nms(dt, boxes, 0.45)
+        expected = np.array([box.classes for box in boxes])
+        result = dt.nms_arrays(coords, scores.copy(), 0.45, batched)
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_do_nms_updates_boxes():
+    dt = imageRecognize.DetectObject()
+    boxes = [imageRecognize.BoundBox(0, 0, 10, 10, classes=np.array([0.9, 0.0])),
+             imageRecognize.BoundBox(1, 1, 10, 10, classes=np.array([0.8, 0.7])),
+             imageRecognize.BoundBox(50, 50, 60, 60, classes=np.array([0.7, 0.0]))]
+    dt.do_nms(boxes, 0.45)
+    assert [list(box.classes) for box in boxes] == [[0.9, 0.0], [0.0, 0.7], [0.7, 0.0]]
@@ -0,0 +1,53 @@
+import asyncio
+from concurrent.futures import Future
+import numpy as np
+import pytest
+import protocol
+from detections import Detections
+
+
+@pytest.mark.parametrize('payload', [b'', b'\x00\x00', protocol.FRAME_HEADER.pack(50) + b'{}',
+                                     protocol.FRAME_HEADER.pack(5) + b'[1,2]', protocol.FRAME_HEADER.pack(4) + b'null',
+                                     protocol.FRAME_HEADER.pack(3) + b'{{{'])
+def test_decode_request_rejects_malformed_frames(payload):
+    with pytest.raises(ValueError):
+        protocol.decode_request(payload)
+
+
+def test_response_round_trip_with_binary_body():
+    detections = Detections([[1, 2, 3, 4], [5, 6, 7, 8]], [0.9, 0.8], [2, 7], [0.7, 0.6])
+    frame = b''.join(protocol.encode_response({'id': 3, 'status': "200"}, detections.to_buffers()))
+    header, body = protocol.decode_response(frame[protocol.FRAME_HEADER.size:])
+    decoded = Detections.from_bytes(body)
+    assert header == {'id': 3, 'status': "200"}
+    np.testing.assert_array_equal(decoded.coords, detections.coords)
+    np.testing.assert_array_equal(decoded.label, detections.label)
+
+
+class ImmediateScheduler:
+
+    def submit(self, *args):
+        future = Future()
+        future.set_result({'status': "200", 'detections': Detections()})
+        return future
+
+
+def test_async_server_answers_malformed_requests():
+    pytest.importorskip('tensorflow')
+    from async_server import AsyncServerSocket
+    serv = AsyncServerSocket.__new__(AsyncServerSocket)
+    serv.scheduler = ImmediateScheduler()
+
+    async def exchange(payload):
+        server = await asyncio.start_server(serv.client_handler, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        writer.write(protocol.encode_frame(payload))
+        response = await asyncio.wait_for(protocol.read_frame(reader), 5)
+        writer.close()
+        server.close()
+        return protocol.decode_response(response)[0]
+
+    for payload in (b'\x00', protocol.FRAME_HEADER.pack(5) + b'[1,2]', protocol.FRAME_HEADER.pack(4) + b'null'):
+        assert asyncio.run(exchange(payload)) == {'status': "400", 'detections': [], 'id': None}
+    request = protocol.encode_request({'id': 1, 'path': 'x.jpg'})[protocol.FRAME_HEADER.size:]
+    assert asyncio.run(exchange(request))['status'] == "200"
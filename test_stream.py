@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+import stream
+
+
+def test_unreadable_frame_is_skipped(tmp_path, fake_model):
+    for name in ('a.jpg', 'c.jpg'):
+        Image.new('RGB', (64, 48)).save(str(tmp_path / name))
+    (tmp_path / 'b.jpg').write_bytes(b'not an image')
+    frames = stream.FrameStream(str(tmp_path), batch_size=2)
+    assert [result['frame'] for result in frames] == [0, 2]
+    assert frames.processed == 2 and frames.failed == 1
+
+
+def test_missing_source_raises(tmp_path, fake_model):
+    frames = stream.FrameStream(str(tmp_path / 'missing.mp4'))
+    with pytest.raises((FileNotFoundError, ImportError)):
+        list(frames)
+
+
+def test_stopping_early_ends_the_prefetch_thread(tmp_path, fake_model):
+    for i in range(12):
+        Image.new('RGB', (64, 48)).save(str(tmp_path / ('%02d.jpg' % i)))
+    frames = stream.FrameStream(str(tmp_path), batch_size=1, prefetch=1)
+    for result in frames:
+        break
+    frames._thread.join(5)
+    assert not frames._thread.is_alive()
+    assert [result['frame'] for result in frames] == list(range(12))
+
+
+def frame_dir(tmp_path, count):
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        Image.fromarray((rng.random((48, 64, 3)) * 255).astype('uint8')).save(str(tmp_path / ('%02d.png' % i)))
+    return str(tmp_path)
+
+
+def test_failed_tiles_are_counted_not_yielded(tmp_path, fake_model):
+    fake_model.error = RuntimeError("predictor failed")
+    frames = stream.FrameStream(frame_dir(tmp_path, 3), tile=True, tile_size=64, tile_overlap=16)
+    assert list(frames) == []
+    assert frames.processed == 0 and frames.failed == 3
+
+
+@pytest.mark.parametrize('options', [{'detection_class': 'spaceship'},
+                                     {'detection_class': 'spaceship', 'tile': True},
+                                     {'tile': True, 'tile_size': 64}])
+def test_bad_options_raise_before_the_first_frame(tmp_path, fake_model, options):
+    frames = stream.FrameStream(frame_dir(tmp_path, 2), **options)
+    with pytest.raises(ValueError):
+        next(iter(frames))
+    assert frames._thread is None
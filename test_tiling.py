@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import main as imageRecognize
+
+
+@pytest.fixture
+def batches(fake_model):
+    # one confident car in the centre cell of every tile
+    fake_model.add(6, 6, 2)
+    return fake_model
+
+
+def batch_sizes(model):
+    return [len(pixels) for shape, pixels in model.calls]
+
+
+def textured(height, width, seed=0):
+    return (np.random.default_rng(seed).random((height, width, 3)) * 255).astype('uint8')
+
+
+def test_tiles_are_batched_shifted_and_flat_tiles_skipped(batches):
+    frame = textured(800, 1200)
+    frame[:, 700:] = 128
+    result = imageRecognize.Start().detect_tiled(frame, 0.6, 'car')
+    assert result['status'] == "200"
+    assert (result['tiles'], result['skipped_tiles']) == (12, 6)
+    assert batch_sizes(batches) == [6]
+    assert sorted(set(result['detections'].coords[:, 0].astype(int).tolist())) == [150, 502]
+    assert set(result['detections'].label.tolist()) == {2}
+
+
+def test_unchanged_tiles_reuse_candidates(batches):
+    startClass = imageRecognize.Start()
+    frame = textured(800, 800)
+    first = startClass.detect_tiled(frame, 0.6, 'car')
+    second = startClass.detect_tiled(frame, 0.6, 'car', previous=first['reference'])
+    assert batch_sizes(batches) == [8, 1]
+    np.testing.assert_array_equal(first['detections'].coords, second['detections'].coords)
+
+
+def test_slow_change_builds_up_until_the_tile_is_rerun(batches):
+    startClass = imageRecognize.Start()
+    frame = textured(800, 800)
+    result = startClass.detect_tiled(frame, 0.6, 'car')
+    rerun = 0
+    for step in range(1, 41):
+        frame[:8 * step, :300] = 255
+        result = startClass.detect_tiled(frame, 0.6, 'car', previous=result['reference'])
+        rerun += result['tiles'] - result['skipped_tiles']
+    assert rerun > 0
+
+
+def test_candidates_are_not_reused_forever(batches):
+    startClass = imageRecognize.Start()
+    frame = textured(416, 416)
+    result = startClass.detect_tiled(frame, 0.6, 'car')
+    for step in range(startClass.TILE_MAX_REUSE + 1):
+        result = startClass.detect_tiled(frame, 0.6, 'car', previous=result['reference'])
+    assert batch_sizes(batches) == [1, 1]
+
+
+def test_object_on_a_seam_is_reported_once(fake_model):
+    # the last cell of the left tile and the first cell of the right tile cover the same pixels
+    fake_model.add(6, 0, 2)
+    fake_model.add(6, 12, 2)
+    result = imageRecognize.Start().detect_tiled(textured(416, 800), 0.6, 'car', overlap=32)
+    assert result['tiles'] == 2
+    centres = (result['detections'].coords[:, 0] + result['detections'].coords[:, 2]) / 2
+    np.testing.assert_allclose(np.sort(centres), [16, 400, 784], atol=1)
@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from threading import Lock
+import pytest
+from metrics import Metrics
+from worker_pool import WorkerPool, worker_environment
+
+
+class DeadProcess:
+    exitcode = -9
+
+    def is_alive(self):
+        return False
+
+
+class LiveProcess(DeadProcess):
+    exitcode = None
+
+    def is_alive(self):
+        return True
+
+
+def make_pool(processes):
+    pool = WorkerPool.__new__(WorkerPool)
+    pool.processes = processes
+    pool.tasks = [None] * len(processes)
+    pool.alive = [True] * len(processes)
+    pool.outstanding = [0] * len(processes)
+    pool._pending = {}
+    pool._lock = Lock()
+    pool._closing = False
+    return pool
+
+
+def test_dead_worker_fails_its_requests_and_frees_shared_memory():
+    pool = make_pool([DeadProcess(), LiveProcess()])
+    shm = shared_memory.SharedMemory(create=True, size=16)
+    lost, kept = Future(), Future()
+    pool._pending = {0: (lost, shm, 0, 0.0, 0, 'a'), 1: (kept, None, 0, 0.0, 1, 'b')}
+    pool.outstanding = [1, 1]
+    pool._reap()
+    assert lost.result(0)['status'] == "500" and lost.result(0)['trace_id'] == 'a'
+    assert not kept.done() and list(pool._pending) == [1]
+    assert pool.alive == [False, True] and pool.outstanding == [0, 1]
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=shm.name)
+
+
+def test_submit_without_live_workers_fails_fast():
+    pool = make_pool([DeadProcess()])
+    pool.alive = [False]
+    assert pool.submit(0, b'image', 0.5, 'all').result(0)['status'] == "500"
+
+
+def test_worker_environment_is_set_for_the_spawn_only(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '64')
+    monkeypatch.delenv('TF_NUM_INTRAOP_THREADS', raising=False)
+    with worker_environment([0, 1]):
+        assert (os.environ['OMP_NUM_THREADS'], os.environ['TF_NUM_INTRAOP_THREADS']) == ('2', '2')
+    assert os.environ['OMP_NUM_THREADS'] == '64' and 'TF_NUM_INTRAOP_THREADS' not in os.environ
+
+
+def test_startup_failure_raises():
+    pytest.importorskip('tensorflow')
+    with pytest.raises(RuntimeError):
+        WorkerPool(1, model_path='missing-model.h5')
+
+
+def test_worker_metrics_are_merged_into_the_front_end():
+    worker, front = Metrics(), Metrics()
+    for batch in (2, 3):
+        worker.inc('yolo_cache_lookups_total', result='miss')
+        worker.set('yolo_cache_entries', batch)
+        worker.observe('yolo_batch_size', batch, Metrics.COUNT_BUCKETS)
+        front.merge(worker.drain(), worker='0')
+    text = front.render()
+    assert 'yolo_cache_lookups_total{result="miss",worker="0"} 2.0' in text
+    assert 'yolo_cache_entries{worker="0"} 3.0' in text
+    assert 'yolo_batch_size_count{worker="0"} 2' in text and 'yolo_batch_size_sum{worker="0"} 5.0' in text
+    assert worker.drain()['counters'] == {}
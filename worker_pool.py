@@ -0,0 +1,249 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from threading import Thread, Lock
+from detections import Detections
+from metrics import METRICS, Profiler, Trace
+
+
+def read_task_image(task):
+    if task[3] is None:
+        return task[2]
+    shm = shared_memory.SharedMemory(name=task[3])
+    try:
+        return bytes(shm.buf[:task[4]])
+    finally:
+        shm.close()
+
+
+@contextmanager
+def worker_environment(cores: list):
+    # spawn re-imports the entry script, and with it TensorFlow, before worker_main runs: thread pool
+    # settings read at import time have to be in the environment the process is started with
+    env = {'OMP_NUM_THREADS': str(len(cores)), 'TF_NUM_INTRAOP_THREADS': str(len(cores)),
+           'TF_NUM_INTEROP_THREADS': '1'}
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def worker_main(worker_id: int, cores: list, tasks, responses, model_path: str, max_batch_size: int,
+                max_wait_ms: float, profile_sample_rate: float = 0.0):
+    # the thread pool environment comes from worker_environment; the TensorFlow runtime itself is only
+    # started by the first model call below, so its pools can still be sized here
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    import main as imageRecognize
+    from server import collect_batch
+
+    if model_path:
+        # requests resolve the default model, it has to be the one this pool was started with
+        imageRecognize.ModelRegistry.MODEL_PATH = model_path
+    startClass = imageRecognize.Start(imageRecognize.DetectionCache())
+    registry = imageRecognize.ModelRegistry()
+    registry.get_model()
+    profiler = Profiler(profile_sample_rate)
+    responses.put((None, worker_id, registry.metrics()))
+    stop = False
+    while not stop:
+        requests, traces, count = [], [], 0
+        for task in collect_batch(tasks, max_batch_size, max_wait_ms):
+            if task is None:
+                stop = True
+                continue
+            if task[0] == 'reload':
+                registry.reload()
+                continue
+            count += 1
+            trace = Trace(task[9])
+            trace.add('queue_wait', time.time() - task[10])
+            if task[1] == 1:
+                status = startClass.start_main(1, read_task_image(task), task[5], task[6], net_size=task[8],
+                                             trace=trace)
+                responses.put((task[0], worker_id, {'status': status, 'detections': Detections(), 'trace_id': trace.id,
+                                                    'timings': trace.timings}))
+            else:
+                requests.append(task)
+                traces.append(trace)
+        if count:
+            METRICS.observe('yolo_batch_size', count, METRICS.COUNT_BUCKETS)
+        if requests:
+            try:
+                results = profiler.run(traces[0].id, startClass.detect_batch,
+                                       [read_task_image(task) for task in requests], [task[5] for task in requests],
+                                       batch_size=len(requests), render=[task[7] for task in requests],
+                                       traces=traces, net_sizes=[task[8] for task in requests],
+                                       detection_classes=[task[6] for task in requests])
+            except BaseException as Err:
+                print([trace.id for trace in traces], Err)
+                results = [{'status': "500", 'detections': Detections(), 'trace_id': trace.id,
+                            'timings': trace.timings} for trace in traces]
+            for task, result in zip(requests, results):
+                responses.put((task[0], worker_id, result))
+        # this process is never scraped, so its cache and batch metrics travel back with the results
+        responses.put(('metrics', worker_id, METRICS.drain()))
+
+
+class WorkerPool:
+    # None lets every worker resolve ModelRegistry's default, which prefers model.wcache
+    MODEL_PATH: str = None
+    STARTUP_TIMEOUT: float = 600
+    POLL_INTERVAL: float = 1.0
+
+    def __init__(self, workers: int, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 model_path: str = None, profile_sample_rate: float = 0.0) -> None:
+        ctx = mp.get_context('spawn')
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        share = max(1, len(cpus) // workers)
+        self.responses = ctx.Queue()
+        self.tasks = []
+        self.processes = []
+        self.outstanding = [0] * workers
+        self.alive = [True] * workers
+        self._closing = False
+        self._pending = {}
+        self._ids = itertools.count()
+        self._lock = Lock()
+        self._stats = {'requests': 0, 'completed': 0, 'workers': {}}
+        for i in range(workers):
+            first = (i * share) % len(cpus)
+            cores = cpus[first:first + share]
+            tasks = ctx.Queue()
+            process = ctx.Process(target=worker_main, daemon=True,
+                                  args=(i, cores, tasks, self.responses, model_path or self.MODEL_PATH,
+                                        max_batch_size, max_wait_ms, profile_sample_rate))
+            with worker_environment(cores):
+                process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+        deadline = time.monotonic() + self.STARTUP_TIMEOUT
+        while len(self._stats['workers']) < workers:
+            try:
+                request_id, worker_id, metrics = self.responses.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                dead = [i for i in range(workers) if not self.processes[i].is_alive()]
+                if dead or time.monotonic() > deadline:
+                    self._terminate()
+                    if dead:
+                        raise RuntimeError("worker " + str(dead[0]) + " exited with code " +
+                                           str(self.processes[dead[0]].exitcode) + " during startup")
+                    raise TimeoutError("workers not ready after " + str(self.STARTUP_TIMEOUT) + "s")
+                continue
+            self._stats['workers'][worker_id] = metrics
+            print("WORKER " + str(worker_id) + " READY " + str(metrics))
+        Thread(target=self._receive, daemon=True).start()
+
+    def submit(self, create_model: int, image, threshold: float, detection_class: str,
+               render: bool = True, net_size=None) -> Future:
+        future = Future()
+        shm, path, size = None, image, 0
+        if isinstance(image, bytes):
+            shm = shared_memory.SharedMemory(create=True, size=max(1, len(image)))
+            shm.buf[:len(image)] = image
+            path, size = None, len(image)
+        trace_id = Trace().id
+        with self._lock:
+            workers = [i for i in range(len(self.tasks)) if self.alive[i]]
+            if not workers:
+                self._release(shm)
+                future.set_result(self._failed(trace_id))
+                return future
+            request_id = next(self._ids)
+            worker_id = min(workers, key=lambda i: self.outstanding[i])
+            self.outstanding[worker_id] += 1
+            self._pending[request_id] = (future, shm, create_model, time.perf_counter(), worker_id, trace_id)
+            self._stats['requests'] += 1
+            METRICS.set('yolo_queue_depth', sum(self.outstanding))
+        self.tasks[worker_id].put((request_id, create_model, path, shm.name if shm else None, size, threshold,
+                                   detection_class, render, net_size, trace_id, time.time()))
+        return future
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, outstanding=list(self.outstanding), workers=dict(self._stats['workers']))
+
+    def close(self):
+        self._closing = True
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+    def _terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    def _failed(self, trace_id):
+        return {'status': "500", 'detections': Detections(), 'trace_id': trace_id, 'timings': {}}
+
+    def _release(self, shm):
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def _reap(self):
+        # a worker that died takes its queued tasks with it: fail them instead of leaving callers waiting
+        failed = []
+        with self._lock:
+            for i, process in enumerate(self.processes):
+                if self.alive[i] and not process.is_alive():
+                    self.alive[i] = False
+                    self.outstanding[i] = 0
+                    print("WORKER " + str(i) + " EXITED WITH CODE " + str(process.exitcode))
+                    for request_id in [key for key, entry in self._pending.items() if entry[4] == i]:
+                        failed.append(self._pending.pop(request_id))
+            METRICS.set('yolo_queue_depth', sum(self.outstanding))
+        for future, shm, create_model, submitted, worker_id, trace_id in failed:
+            self._release(shm)
+            result = self._failed(trace_id)
+            METRICS.record_result(result, time.perf_counter() - submitted)
+            future.set_result(result)
+
+    def _receive(self):
+        checked = time.monotonic()
+        while True:
+            try:
+                request_id, worker_id, result = self.responses.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                request_id = None
+            if not self._closing and time.monotonic() - checked >= self.POLL_INTERVAL:
+                self._reap()
+                checked = time.monotonic()
+            if request_id is None:
+                continue
+            if request_id == 'metrics':
+                METRICS.merge(result, worker=str(worker_id))
+                continue
+            with self._lock:
+                entry = self._pending.pop(request_id, None)
+                if entry is None:
+                    continue
+                future, shm, create_model, submitted = entry[:4]
+                self.outstanding[worker_id] -= 1
+                self._stats['completed'] += 1
+                METRICS.set('yolo_queue_depth', sum(self.outstanding))
+            self._release(shm)
+            if create_model == 1:
+                # the model was rebuilt on disk, every other worker has to pick it up
+                for i in range(len(self.tasks)):
+                    if i != worker_id and self.alive[i]:
+                        self.tasks[i].put(('reload',))
+            METRICS.record_result(result, time.perf_counter() - submitted)
+            future.set_result(result)